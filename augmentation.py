@@ -0,0 +1,74 @@
+"""
+batched augmentation on the training device
+
+with --gpu_augmentation the loader workers only decode, resize and normalize, and the random part of the
+augmentation of load_data (A.Rotate(limit=5, p=0.3) and A.InvertImg(p=0.3)) is applied to the whole batch
+after collation, with one consistent transform for the image and its targets or landmark coordinates
+
+reference:
+    affine_grid / grid_sample:
+        https://pytorch.org/docs/stable/generated/torch.nn.functional.affine_grid.html
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchAugmentation():
+    def __init__(
+            self, args, rotate_limit=5, rotate_p=0.3, invert_p=0.3,
+            mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+        ):
+        ## random parameters come from a cpu generator seeded like customize_seed, so runs are reproducible on any device
+        self.generator = torch.Generator().manual_seed(args.seed)
+        self.rotate_limit = rotate_limit
+        self.rotate_p = rotate_p
+        self.invert_p = invert_p
+
+        ## InvertImg is 255 - x before Normalize, which is (1 - 2*mean)/std - x after Normalize
+        self.inverted = (1 - 2 * torch.tensor(mean)) / torch.tensor(std)
+
+    def sample(self, batch_size):
+        rotate = torch.rand(batch_size, generator=self.generator) < self.rotate_p
+        angles = (torch.rand(batch_size, generator=self.generator) * 2 - 1) * self.rotate_limit
+        angles = torch.deg2rad(angles * rotate)
+        invert = torch.rand(batch_size, generator=self.generator) < self.invert_p
+        return angles, invert
+
+    def __call__(self, images, targets, coordinates=False):
+        """
+        images: B x 3 x H x W normalized images
+        targets: B x C x H x W dense targets, or B x C x 2 (y, x) landmark coordinates when coordinates is True
+        """
+        batch_size, _, height, width = images.shape
+        angles, invert = self.sample(batch_size)
+        angles, invert = angles.to(images.device), invert.to(images.device)
+        cos, sin = torch.cos(angles), torch.sin(angles)
+
+        ## output pixel p samples the input at R p (normalized x, y coordinates)
+        theta = torch.zeros(batch_size, 2, 3, device=images.device, dtype=images.dtype)
+        theta[:, 0, 0], theta[:, 0, 1] = cos, -sin
+        theta[:, 1, 0], theta[:, 1, 1] = sin, cos
+
+        grid = F.affine_grid(theta, list(images.shape), align_corners=False)
+        images = F.grid_sample(images, grid, mode='bilinear', padding_mode='reflection', align_corners=False)
+        inverted = self.inverted.to(images.device, images.dtype).view(1, -1, 1, 1) - images
+        images = torch.where(invert.view(-1, 1, 1, 1), inverted, images)
+
+        if coordinates:
+            ## the content at input point p ends up at R^T p
+            targets = targets.float()
+            y = (2 * targets[..., 0] + 1) / height - 1
+            x = (2 * targets[..., 1] + 1) / width - 1
+            cos, sin = cos.view(-1, 1), sin.view(-1, 1)
+            rotated_x = cos * x + sin * y
+            rotated_y = -sin * x + cos * y
+            targets = torch.stack([
+                ((rotated_y + 1) * height - 1) / 2,
+                ((rotated_x + 1) * width - 1) / 2,
+            ], dim=-1)
+        else:
+            grid = F.affine_grid(theta, list(targets.shape), align_corners=False)
+            targets = F.grid_sample(targets.float(), grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+        return images, targets
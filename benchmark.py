@@ -0,0 +1,171 @@
+"""
+benchmarks for the preprocessing and training hot paths
+
+usage:
+    python benchmark.py overlay --height 2000 --width 1000
+    python benchmark.py amp --pretrained --batch_size 12 --image_resize 512
+"""
+
+import argparse
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+
+from preprocess import place_overlay, customize_seed
+from argument import arg_as_list
+from utility import get_autocast
+
+
+def legacy_place_overlay(original_shape, annotation_arr, origin):
+    """
+    overlay placement of the previous overlay_two_images, kept only as the baseline of the benchmark
+    """
+    left_fill = origin[1]-1
+    middle_fill = len(annotation_arr[0])
+    right_fill = original_shape[1]-(origin[1]-1)-len(annotation_arr[0])
+
+    new_arr = np.array(
+        [[0]*(left_fill+middle_fill+right_fill) for _ in range(len(annotation_arr))]
+    )
+    for j in range(len(annotation_arr)):
+        left = np.array([0]*left_fill)
+        middle = annotation_arr[j]
+        right = np.array([0]*right_fill)
+
+        tmp = np.concatenate((left, middle), axis=0)
+        new_arr[j] = np.concatenate((tmp, right), axis=0)
+
+    if original_shape[0] > annotation_arr.shape[0]:
+        upper_fill = origin[0]-1
+        lower_fill = original_shape[0]-(origin[0]-1)-len(annotation_arr)
+
+        high = np.zeros((upper_fill, original_shape[1]))
+        low = np.zeros((lower_fill, original_shape[1]))
+
+        tmp = np.vstack([high, new_arr])
+        new_arr = np.vstack([tmp, low])
+
+    change_arr = np.asarray(new_arr, dtype = np.int32)
+    for j in range(len(change_arr)):
+        for k in range(len(change_arr[j])):
+            if change_arr[j][k] == 1:
+                change_arr[j][k] = 254
+
+    norm = (change_arr - np.min(change_arr)) / (np.max(change_arr) - np.min(change_arr))
+    return np.uint8(norm*255)[:original_shape[0]]
+
+
+def timeit(function, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed.append(time.perf_counter() - start)
+    return result, min(elapsed)
+
+
+def benchmark_overlay(args):
+    rng = np.random.default_rng(args.seed)
+    original_shape = (args.height, args.width)
+    overlay = (rng.random((args.height - 2*args.margin, args.width - 2*args.margin)) < 0.01).astype(np.uint8)
+    origin = (args.margin + 1, args.margin + 1)
+
+    legacy, legacy_time = timeit(lambda: legacy_place_overlay(original_shape, overlay, origin), 1)
+    vectorized, vectorized_time = timeit(lambda: place_overlay(original_shape, overlay, origin), args.repeat)
+    assert np.array_equal(legacy, vectorized), "vectorized overlay does not match the legacy overlay"
+
+    print(f"overlay {args.height}x{args.width}")
+    print(f"legacy:     {legacy_time:.4f} s")
+    print(f"vectorized: {vectorized_time:.4f} s")
+    print(f"speedup:    {legacy_time/vectorized_time:.1f}x")
+
+
+def benchmark_train_step(args, device):
+    """
+    images per second and peak device memory of training steps on synthetic batches, in fp32 or with --amp
+    """
+    ## imported here so the overlay benchmark runs without segmentation_models_pytorch
+    from model import get_model, get_pretrained_model
+
+    customize_seed(args.seed)
+    if args.pretrained: model = get_pretrained_model(args, device)
+    else:               model = get_model(args, device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loss_fn = nn.BCEWithLogitsLoss()
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and device == 'cuda')
+
+    data = torch.randn(args.batch_size, 3, args.image_resize, args.image_resize, device=device)
+    targets = (torch.rand(args.batch_size, args.output_channel, args.image_resize, args.image_resize, device=device) < 0.01).float()
+
+    def step():
+        with get_autocast(args, device):
+            predictions = model(data)
+        loss = loss_fn(predictions.float(), targets)
+        optimizer.zero_grad()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    model.train()
+    for _ in range(args.warmup):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    memory = torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else None
+    del model, optimizer
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+    return args.batch_size * args.steps / elapsed, memory
+
+
+def benchmark_amp(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    results = {}
+    for amp in (False, True):
+        args.amp = amp
+        results[amp] = benchmark_train_step(args, device)
+
+    (fp32_speed, fp32_memory), (amp_speed, amp_memory) = results[False], results[True]
+    print(f"train step {args.batch_size}x3x{args.image_resize}x{args.image_resize} on {device}, amp in {'float16' if device == 'cuda' else 'bfloat16'}")
+    print(f"fp32: {fp32_speed:.2f} images/s")
+    print(f"amp:  {amp_speed:.2f} images/s")
+    print(f"speedup: {amp_speed/fp32_speed:.2f}x")
+    if device == 'cuda':
+        print(f"peak memory fp32: {fp32_memory:.0f} MB, amp: {amp_memory:.0f} MB, delta: {amp_memory - fp32_memory:+.0f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    overlay_parser = subparsers.add_parser('overlay', help='overlay reconstruction of preprocess.overlay_two_images')
+    overlay_parser.add_argument('--height', type=int, default=2000, help='height of the synthetic original image')
+    overlay_parser.add_argument('--width', type=int, default=1000, help='width of the synthetic original image')
+    overlay_parser.add_argument('--margin', type=int, default=100, help='distance between the overlay and the image border')
+    overlay_parser.add_argument('--repeat', type=int, default=5, help='number of repetitions of the vectorized version')
+    overlay_parser.add_argument('--seed', type=int, default=2022, help='seed of the synthetic overlay')
+    overlay_parser.set_defaults(function=benchmark_overlay)
+
+    amp_parser = subparsers.add_parser('amp', help='training step throughput and peak memory of --amp against fp32')
+    amp_parser.add_argument('--pretrained', action='store_true', help='whether to benchmark the pretrained model')
+    amp_parser.add_argument('--batch_size', type=int, default=12, help='batch size')
+    amp_parser.add_argument('--image_resize', type=int, default=512, help='image resize value')
+    amp_parser.add_argument('--output_channel', type=int, default=6, help='output channel size for UNet')
+    amp_parser.add_argument('--encoder_depth', type=int, default=5, help='model depth for UNet')
+    amp_parser.add_argument("--decoder_channel", type=arg_as_list, default=[256,128,64,32,16], help='model decoder channels')
+    amp_parser.add_argument('--warmup', type=int, default=3, help='number of untimed steps')
+    amp_parser.add_argument('--steps', type=int, default=10, help='number of timed steps')
+    amp_parser.add_argument('--seed', type=int, default=2022, help='seed of the model initialization')
+    amp_parser.set_defaults(function=benchmark_amp)
+
+    args = parser.parse_args()
+    args.function(args)
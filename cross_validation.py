@@ -0,0 +1,151 @@
+"""
+concurrent k-fold cross validation
+
+the image store is built once, then every fold is trained as a separate `main.py --num_folds K --fold k` process
+that reads it through the shared page cache (or from the shards with --use_shards). at most --max_concurrent folds
+run at the same time, the gpus are handed out round robin and the cpu threads are split between the running folds.
+the validation metrics of the best checkpoint of every fold (plot_results/{wandb_name}_fold{k}/results/metrics.json)
+are aggregated into plot_results/{wandb_name}_cv/report.json
+
+usage:
+    python cross_validation.py --num_folds 5 --max_concurrent 2 --pixel_loss --pretrained ... --wandb_name cv
+every argument that is not an argument of the runner is passed on to main.py
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import torch
+import numpy as np
+
+from main import get_parser
+from image_store import build_image_store, get_store_paths
+from dataset import get_available_cpus
+
+
+## steps that have to run once before the folds, not once per fold
+ONE_TIME_FLAGS = ['--data_preprocessing', '--pad_image', '--create_dataset', '--build_image_store', '--export_shards']
+
+
+def get_gpus(cv_args):
+    if cv_args.gpus:
+        return cv_args.gpus.split(',')
+    if os.environ.get('CUDA_VISIBLE_DEVICES'):
+        return os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+    return [str(gpu) for gpu in range(torch.cuda.device_count())]
+
+
+def get_fold_command(argv, args, cv_args, fold, threads):
+    command = [sys.executable, 'main.py', *argv]
+    if not args.use_shards:
+        command += ['--image_store']
+    if '--loader_workers' not in argv:
+        command += ['--loader_workers', str(max(threads - 1, 0))]
+    command += [
+        '--num_folds', str(cv_args.num_folds), '--fold', str(fold),
+        '--wandb_name', f'{args.wandb_name}_fold{fold}',
+    ]
+    return command
+
+
+def run_folds(argv, args, cv_args):
+    print("---------- Starting Cross Validation ----------")
+    gpus = get_gpus(cv_args)
+    max_concurrent = cv_args.max_concurrent or max(len(gpus), 1)
+    threads = max(cv_args.cpu_budget // max_concurrent, 1)
+    log_path = f'./plot_results/{args.wandb_name}_cv'
+    os.makedirs(log_path, exist_ok=True)
+    print(f"{cv_args.num_folds} folds, {max_concurrent} at a time, gpus {gpus}, {threads} threads per fold")
+
+    pending, running, returncodes = list(range(cv_args.num_folds)), {}, {}
+    while pending or running:
+        while pending and len(running) < max_concurrent:
+            fold = pending.pop(0)
+            env = os.environ.copy()
+            env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(threads)
+            if gpus:
+                env['CUDA_VISIBLE_DEVICES'] = gpus[fold % len(gpus)]
+            log = open(f'{log_path}/fold{fold}.log', 'w')
+            process = subprocess.Popen(
+                get_fold_command(argv, args, cv_args, fold, threads), env=env, stdout=log, stderr=subprocess.STDOUT
+            )
+            running[fold] = (process, log)
+            print(f"fold {fold} started on gpu {env.get('CUDA_VISIBLE_DEVICES', '-')}, log in {log_path}/fold{fold}.log")
+
+        for fold, (process, log) in list(running.items()):
+            if process.poll() is not None:
+                log.close()
+                returncodes[fold] = process.returncode
+                del running[fold]
+                print(f"fold {fold} finished with exit code {process.returncode}")
+        time.sleep(1)
+
+    print("---------- Cross Validation Done ----------\n")
+    return returncodes
+
+
+def aggregate_folds(args, num_folds):
+    folds = []
+    for fold in range(num_folds):
+        metrics_path = f'./plot_results/{args.wandb_name}_fold{fold}/results/metrics.json'
+        if not os.path.exists(metrics_path):
+            print(f"fold {fold} has no metrics, it is left out of the report")
+            continue
+        with open(metrics_path, 'r') as f:
+            metrics = json.load(f)
+        metrics['fold'] = fold
+        folds.append(metrics)
+    if not folds:
+        return None
+
+    summary = {}
+    for key in ('rmse', 'LDFA', 'MPTA', 'mHKA'):
+        values = np.array([metrics[key] for metrics in folds])
+        summary[key] = {'mean': float(values.mean()), 'std': float(values.std())}
+    landmarks = np.array([metrics['rmse_landmarks'] for metrics in folds])
+    summary['rmse_landmarks'] = {'mean': landmarks.mean(axis=0).tolist(), 'std': landmarks.std(axis=0).tolist()}
+
+    report = {'num_folds': num_folds, 'folds': folds, 'summary': summary}
+    with open(f'./plot_results/{args.wandb_name}_cv/report.json', 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"{len(folds)}/{num_folds} folds")
+    for key in ('rmse', 'LDFA', 'MPTA', 'mHKA'):
+        print(f"{key}: {summary[key]['mean']:.3f} +- {summary[key]['std']:.3f}")
+    for i, (mean, std) in enumerate(zip(summary['rmse_landmarks']['mean'], summary['rmse_landmarks']['std'])):
+        print(f"label{i} rmse: {mean:.3f} +- {std:.3f}")
+    return report
+
+
+def main(argv, cv_args):
+    ignored = [flag for flag in argv if flag in ONE_TIME_FLAGS]
+    if ignored:
+        print(f"{ignored} are not run for every fold, run main.py with them once before the cross validation")
+        argv = [flag for flag in argv if flag not in ONE_TIME_FLAGS]
+    args = get_parser().parse_args(argv)
+
+    ## the images are decoded once for all folds
+    if not args.use_shards and (cv_args.rebuild_image_store or not os.path.exists(get_store_paths(args)[1])):
+        build_image_store(args)
+
+    returncodes = run_folds(argv, args, cv_args)
+    failed = [fold for fold, returncode in returncodes.items() if returncode != 0]
+    if failed:
+        print(f"folds {failed} failed, see their logs")
+    aggregate_folds(args, cv_args.num_folds)
+
+
+if __name__ == '__main__':
+    ## no abbreviations, so that the arguments of main.py are never taken for arguments of the runner
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--num_folds', type=int, default=5, help='number of cross validation folds')
+    parser.add_argument('--max_concurrent', type=int, default=0, help='number of folds trained at the same time, 0 for one per gpu')
+    parser.add_argument('--gpus', type=str, default="", help='comma separated gpu ids handed out to the folds, all visible gpus if empty')
+    parser.add_argument('--cpu_budget', type=int, default=get_available_cpus(), help='number of cpu threads split between the running folds')
+    parser.add_argument('--rebuild_image_store', action='store_true', help='whether to build the image store again before the folds')
+
+    cv_args, argv = parser.parse_known_args()
+    main(argv, cv_args)
@@ -42,7 +42,7 @@ def main():
     # 이미지 디렉토리 경로를 입력 받는다.
     path = GetArgument()
     # path의 이미지명을 받는다.
-    image_names = sorted(os.listdir(path))
+    image_names = sorted(name for name in os.listdir(path) if name.endswith('.png'))
 
     # path를 구분하는 delimiter를 구한다.
     if len(path.split('\\')) > 1:
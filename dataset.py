@@ -14,154 +14,492 @@ reference:
 """
 
 
+import os
 import cv2
 import csv
+import json
+import time
+import hashlib
+import platform
+import multiprocessing as mp
 import torch
 import pandas as pd
 import numpy as np
 import albumentations as A
 
 from albumentations.pytorch import ToTensorV2
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 from PIL import Image
 from tqdm import tqdm
-from scipy import ndimage
+from functools import lru_cache
+
+from preprocess import load_pad_metadata
+from image_store import ImageStore
+from manifest import PreprocessManifest
+
+
+class ErosionSchedule():
+    """
+    dilation radius of the targets for the current epoch, decreased by dilation_decrease every dilation_epoch
+    with --progressive_erosion. the radius lives in shared memory, so the (persistent) loader workers see the
+    radius of the current epoch without the loaders being rebuilt
+    """
+    def __init__(self, args):
+        self.initial = args.dilate
+        self.decrease = args.dilation_decrease
+        self.dilation_epoch = args.dilation_epoch
+        self.progressive = args.progressive_erosion
+        self.value = mp.Value('i', args.dilate)
+
+    def dilate_at(self, epoch):
+        if not self.progressive:
+            return self.initial
+        return max(self.initial - self.decrease * (epoch // self.dilation_epoch), 0)
+
+    def set_epoch(self, epoch):
+        self.value.value = self.dilate_at(epoch)
+        return self.value.value
+
+    @property
+    def dilate(self):
+        return self.value.value
+
+
+def get_image_names(image_dirs):
+    return [f'{image_dir.split("_")[0]}_pad.png' for image_dir in image_dirs]
+
+
+def make_item(image, coordinates, image_dir, args, transform, dilate):
+    """
+    (image, targets, image_dir, label_list) item of a loaded image and its C x 2 landmark coordinates
+    """
+    ## [y0, x0, y1, x1, ...] as before, collated into a list of 2*output_channel tensors
+    label_list = coordinates.reshape(-1).tolist()
+    coordinates = coordinates.astype(np.float32)
+
+    ## only the landmark coordinates are shipped, the targets are synthesized on the training device
+    if args.coordinate_targets:
+        ## keypoints are given in the frame of the loaded image so that Resize brings them back to image_resize
+        coordinates[:, 0] *= image.shape[0] / args.image_resize
+        coordinates[:, 1] *= image.shape[1] / args.image_resize
+        if transform:
+            augmentations = transform(image=image, keypoints=coordinates)
+            image = augmentations["image"]
+            coordinates = np.array(augmentations["keypoints"], dtype=np.float32)
+        return image, torch.from_numpy(coordinates), image_dir, label_list
+
+    masks = generate_target_masks(coordinates, args.image_resize, dilate, args.target_type)
+    masks = list(masks)
+    if transform:
+        augmentations = transform(image=image, masks=masks)
+        image = augmentations["image"]
+        masks = augmentations["masks"]
+    masks = torch.stack([torch.as_tensor(mask) for mask in masks], dim=0)
+
+    return image, masks, image_dir, label_list
+
+
+class SharedImageCache():
+    """
+    decoded images shared by all dataloader workers, opt-in with --shared_cache_mb
+    images are kept resized to image_resize (what A.Resize would give) in the slots of one uint8 tensor in shared
+    memory allocated at startup. when the budget holds fewer slots than images, the least recently used slot is evicted
+    """
+    def __init__(self, args, image_names):
+        self.image_resize = args.image_resize
+        self.index = {image_name: i for i, image_name in enumerate(sorted(set(image_names)))}
+        slot_size = args.image_resize * args.image_resize
+        num_slots = max(min(len(self.index), args.shared_cache_mb * 2**20 // slot_size), 1)
+
+        self.pool = torch.zeros((num_slots, args.image_resize, args.image_resize), dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((len(self.index),), -1, dtype=torch.int64).share_memory_()
+        self.owner = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros(num_slots, dtype=torch.int64).share_memory_()
+        self.clock = mp.Value('q', 0, lock=False)
+        self.lock = mp.Lock()
+        print(f"shared image cache: {num_slots} slots for {len(self.index)} images")
+
+    def touch(self, slot):
+        self.clock.value += 1
+        self.last_used[slot] = self.clock.value
+
+    def get(self, image_name, decode_image):
+        i = self.index[image_name]
+        with self.lock:
+            slot = int(self.slot_of[i])
+            if slot >= 0:
+                self.touch(slot)
+                ## copied under the lock so that the slot cannot be evicted while it is read
+                image = self.pool[slot].numpy().copy()
+        if slot < 0:
+            ## decoded outside of the lock, the other workers keep reading meanwhile
+            image = decode_image(image_name)[..., 0]
+            image = cv2.resize(image, (self.image_resize, self.image_resize), interpolation=cv2.INTER_LINEAR)
+            with self.lock:
+                slot = int(self.slot_of[i])
+                if slot < 0:
+                    slot = int(torch.argmin(self.last_used))
+                    if self.owner[slot] >= 0:
+                        self.slot_of[self.owner[slot]] = -1
+                    self.pool[slot] = torch.from_numpy(image)
+                    self.owner[slot], self.slot_of[i] = i, slot
+                self.touch(slot)
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
 
 
 class CustomDataset(Dataset):
-    def __init__(self, df, args, transform=None):
+    def __init__(self, df, args, transform=None, erosion_schedule=None, shared_cache=None):
         super().__init__()
         self.args = args
         self.df = df.reset_index()
+        ## the csv is converted once into image names and an N x C x 2 (y, x) array, so an item is a plain slice
+        self.image_names = get_image_names(self.df['image'])
+        self.coordinates = get_label_coordinates(self.df, args.output_channel)
         self.dataset_path = args.padded_image
         self.image_resize = args.image_resize
         self.delete_method = args.delete_method
         self.transform = transform
+        self.erosion_schedule = erosion_schedule if erosion_schedule is not None else ErosionSchedule(args)
+        self.image_store = ImageStore(args) if args.image_store else None
+        self.shared_cache = shared_cache
+        self.transform_cache = TransformCache(args, self.image_names) if args.transform_cache else None
         
     def __len__(self):
-        return len(self.df)
+        return len(self.image_names)
+
+    @property
+    def dilate(self):
+        return self.erosion_schedule.dilate
+
+    def load_image(self, image_dir):
+        if self.shared_cache is not None:
+            return self.shared_cache.get(image_dir, self.decode_image)
+        return self.decode_image(image_dir)
+
+    def decode_image(self, image_dir):
+        ## zero-copy slice of the packed store (already resized to image_resize) instead of decoding the png
+        if self.image_store is not None and image_dir in self.image_store:
+            return cv2.cvtColor(self.image_store[image_dir], cv2.COLOR_GRAY2RGB)
+        return np.array(Image.open(f'{self.dataset_path}/{image_dir}').convert("RGB"))
 
     def __getitem__(self, idx):
-        self.df = self.df.fillna(0)
-        image_dir = self.df['image'][idx]
-        image_dir = f'{image_dir.split("_")[0]}_pad.png'
-        image_path = f'{self.dataset_path}/{image_dir}'
-        image = np.array(Image.open(image_path).convert("RGB"))
-
-        if self.args.output_channel == 6:
-            # label_0_y, label_0_x = self.df['label_0_y'][idx], self.df['label_0_x'][idx]
-            # label_1_y, label_1_x = self.df['label_1_y'][idx], self.df['label_1_x'][idx]
-            # label_2_y, label_2_x = self.df['label_3_y'][idx], self.df['label_3_x'][idx]
-            # label_3_y, label_3_x = self.df['label_4_y'][idx], self.df['label_4_x'][idx]
-            # label_4_y, label_4_x = self.df['label_6_y'][idx], self.df['label_6_x'][idx]
-            # label_5_y, label_5_x = self.df['label_7_y'][idx], self.df['label_7_x'][idx]
-            # label_list = [
-            #     label_0_y, label_0_x, label_1_y, label_1_x, label_2_y, label_2_x,
-            #     label_3_y, label_3_x, label_4_y, label_4_x, label_5_y, label_5_x,
-            # ]
-
-            label_0_y, label_0_x = self.df['label_0_y'][idx], self.df['label_0_x'][idx]
-            label_1_y, label_1_x = self.df['label_1_y'][idx], self.df['label_1_x'][idx]
-            label_2_y, label_2_x = self.df['label_2_y'][idx], self.df['label_2_x'][idx]
-            label_3_y, label_3_x = self.df['label_3_y'][idx], self.df['label_3_x'][idx]
-            label_4_y, label_4_x = self.df['label_4_y'][idx], self.df['label_4_x'][idx]
-            label_5_y, label_5_x = self.df['label_5_y'][idx], self.df['label_5_x'][idx]
-            label_list = [
-                label_0_y, label_0_x, label_1_y, label_1_x, label_2_y, label_2_x,
-                label_3_y, label_3_x, label_4_y, label_4_x, label_5_y, label_5_x,
-            ]
-
-            mask0 = np.zeros([self.image_resize, self.image_resize])
-            mask1 = np.zeros([self.image_resize, self.image_resize])
-            mask2 = np.zeros([self.image_resize, self.image_resize])
-            mask3 = np.zeros([self.image_resize, self.image_resize])
-            mask4 = np.zeros([self.image_resize, self.image_resize])
-            mask5 = np.zeros([self.image_resize, self.image_resize])
-
-            mask0 = dilate_pixel(mask0, label_0_y, label_0_x, self.args)
-            mask1 = dilate_pixel(mask1, label_1_y, label_1_x, self.args)
-            mask2 = dilate_pixel(mask2, label_2_y, label_2_x, self.args)
-            mask3 = dilate_pixel(mask3, label_3_y, label_3_x, self.args)
-            mask4 = dilate_pixel(mask4, label_4_y, label_4_x, self.args)
-            mask5 = dilate_pixel(mask5, label_5_y, label_5_x, self.args)
-
-            if self.transform:
-                augmentations = self.transform(image=image, masks=[
-                    mask0, mask1, mask2, mask3, mask4, mask5
-                ])
-                
-                image = augmentations["image"]
-                mask0 = augmentations["masks"][0]
-                mask1 = augmentations["masks"][1]
-                mask2 = augmentations["masks"][2]
-                mask3 = augmentations["masks"][3]
-                mask4 = augmentations["masks"][4]
-                mask5 = augmentations["masks"][5]
-
-            masks = torch.stack([mask0, mask1, mask2, mask3, mask4, mask5], dim=0)
-
-        # elif self.args.output_channel == 8:
+        image_dir = self.image_names[idx]
+        if self.transform_cache is not None and image_dir in self.transform_cache:
+            image = self.transform_cache.load(image_dir, self.load_image)
         else:
-            label_0_y, label_0_x = self.df['label_0_y'][idx], self.df['label_0_x'][idx]
-            label_1_y, label_1_x = self.df['label_1_y'][idx], self.df['label_1_x'][idx]
-            label_2_y, label_2_x = self.df['label_2_y'][idx], self.df['label_2_x'][idx]
-            label_3_y, label_3_x = self.df['label_3_y'][idx], self.df['label_3_x'][idx]
-            label_4_y, label_4_x = self.df['label_4_y'][idx], self.df['label_4_x'][idx]
-            label_5_y, label_5_x = self.df['label_5_y'][idx], self.df['label_5_x'][idx]
-            label_6_y, label_6_x = self.df['label_6_y'][idx], self.df['label_6_x'][idx]
-            label_7_y, label_7_x = self.df['label_7_y'][idx], self.df['label_7_x'][idx]
-            label_list = [
-                label_0_y, label_0_x, label_1_y, label_1_x, label_2_y, label_2_x,
-                label_3_y, label_3_x, label_4_y, label_4_x, label_5_y, label_5_x,
-                label_6_y, label_6_x, label_7_y, label_7_x
-            ]
-
-            mask0 = np.zeros([self.image_resize, self.image_resize])
-            mask1 = np.zeros([self.image_resize, self.image_resize])
-            mask2 = np.zeros([self.image_resize, self.image_resize])
-            mask3 = np.zeros([self.image_resize, self.image_resize])
-            mask4 = np.zeros([self.image_resize, self.image_resize])
-            mask5 = np.zeros([self.image_resize, self.image_resize])
-            mask6 = np.zeros([self.image_resize, self.image_resize])
-            mask7 = np.zeros([self.image_resize, self.image_resize])
-
-            mask0 = dilate_pixel(mask0, label_0_y, label_0_x, self.args)
-            mask1 = dilate_pixel(mask1, label_1_y, label_1_x, self.args)
-            mask2 = dilate_pixel(mask2, label_2_y, label_2_x, self.args)
-            mask3 = dilate_pixel(mask3, label_3_y, label_3_x, self.args)
-            mask4 = dilate_pixel(mask4, label_4_y, label_4_x, self.args)
-            mask5 = dilate_pixel(mask5, label_5_y, label_5_x, self.args)
-            mask6 = dilate_pixel(mask6, label_6_y, label_6_x, self.args)
-            mask7 = dilate_pixel(mask7, label_7_y, label_7_x, self.args)
-
-            if self.transform:
-                augmentations = self.transform(image=image, masks=[
-                    mask0, mask1, mask2, mask3, mask4, mask5, mask6, mask7
-                ])
-                
-                image = augmentations["image"]
-                mask0 = augmentations["masks"][0]
-                mask1 = augmentations["masks"][1]
-                mask2 = augmentations["masks"][2]
-                mask3 = augmentations["masks"][3]
-                mask4 = augmentations["masks"][4]
-                mask5 = augmentations["masks"][5]
-                mask6 = augmentations["masks"][6]
-                mask7 = augmentations["masks"][7]
-
-            masks = torch.stack([mask0, mask1, mask2, mask3, mask4, mask5, mask6, mask7], dim=0)
-
-        return image, masks, image_dir, label_list
-
-
-def dilate_pixel(mask, label_y, label_x, args):
-    if label_y == 512: label_y -= 1
-    if label_x == 512: label_x -= 1
-    mask[label_y][label_x] = 1.0
-    struct = ndimage.generate_binary_structure(2, 1)
-    dilated_mask = ndimage.binary_dilation(mask, structure=struct, iterations=args.dilate).astype(mask.dtype)
-
-    return dilated_mask
+            image = self.load_image(image_dir)
+
+        return make_item(image, self.coordinates[idx], image_dir, self.args, self.transform, self.dilate)
+
+
+def get_label_coordinates(df, output_channel):
+    """
+    N x output_channel x 2 int32 array from the label_{k}_y / label_{k}_x columns of dataset.csv, missing labels are 0
+    """
+    columns = [f'label_{k}_{axis}' for k in range(output_channel) for axis in ('y', 'x')]
+    coordinates = df[columns].fillna(0).to_numpy(dtype=np.int32)
+    return np.ascontiguousarray(coordinates.reshape(len(df), output_channel, 2))
+
+
+def count_shard_rows(args, group):
+    with open(f'{args.shard_path}/index.json', 'r') as f:
+        index = json.load(f)
+    return sum(shard['count'] for shard in index['shards'] if shard['group'] == group)
+
+
+class ShardDataset(IterableDataset):
+    """
+    streams the shards written by shards.export_shards with one sequential read per shard, instead of opening
+    every png. only the given rows of the group are yielded, shuffled within a buffer of --shuffle_buffer items
+    """
+    def __init__(self, args, group, rows, transform=None, erosion_schedule=None, shuffle=False):
+        super().__init__()
+        with open(f'{args.shard_path}/index.json', 'r') as f:
+            index = json.load(f)
+        if index['image_resize'] != args.image_resize or index['output_channel'] != args.output_channel:
+            raise ValueError(
+                f"shards in {args.shard_path} hold {index['output_channel']} landmarks at {index['image_resize']}, "
+                f"export them again for {args.output_channel} landmarks at {args.image_resize}"
+            )
+        self.args = args
+        self.shards = [shard for shard in index['shards'] if shard['group'] == group]
+        self.rows = set(rows)
+        self.length = sum(len(self.rows.intersection(range(shard['start'], shard['start'] + shard['count']))) for shard in self.shards)
+        self.transform = transform
+        self.erosion_schedule = erosion_schedule if erosion_schedule is not None else ErosionSchedule(args)
+        self.shuffle = shuffle
+        self.epoch = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def dilate(self):
+        return self.erosion_schedule.dilate
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        ## every (persistent) worker counts the epochs, the shard order is the same in all of them
+        shard_order = np.random.default_rng([self.args.seed, self.epoch]).permutation(len(self.shards))
+        rng = np.random.default_rng([self.args.seed, self.epoch, worker_id])
+        self.epoch += 1
+        shards = [self.shards[i] for i in shard_order] if self.shuffle else self.shards
+
+        buffer = []
+        for shard in shards[worker_id::num_workers]:
+            with np.load(f"{self.args.shard_path}/{shard['file']}") as data:
+                images, coordinates, names = data['images'], data['coordinates'], data['names']
+            for i, row in enumerate(range(shard['start'], shard['start'] + shard['count'])):
+                if row not in self.rows:
+                    continue
+                buffer.append((images[i], coordinates[i], str(names[i])))
+                if len(buffer) >= (self.args.shuffle_buffer if self.shuffle else 1):
+                    yield self.make_item(buffer, rng)
+        while buffer:
+            yield self.make_item(buffer, rng)
+
+    def make_item(self, buffer, rng):
+        j = int(rng.integers(len(buffer))) if self.shuffle else 0
+        image, coordinates, image_dir = buffer.pop(j)
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        return make_item(image, coordinates, image_dir, self.args, self.transform, self.dilate)
+
+
+class TransformCache():
+    """
+    on-disk cache of the deterministic prefix of the transform (Resize + Normalize), shared across runs
+    one float32 image_resize x image_resize x 3 .npy per key, the key being the sha256 of the source png,
+    image_resize, mean and std, so a changed image or changed parameters never hit a stale entry
+    """
+    def __init__(self, args, image_names, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.path = args.transform_cache_path
+        os.makedirs(self.path, exist_ok=True)
+        self.prefix = A.Compose([
+            A.Resize(height=args.image_resize, width=args.image_resize),
+            A.Normalize(mean=mean, std=std, max_pixel_value=255.0),
+        ])
+
+        ## the source digests are kept in a manifest next to the cache, so only new or changed pngs are hashed again
+        manifest = PreprocessManifest(f'{self.path}/manifest.json')
+        params = f'{args.image_resize}:{mean}:{std}'
+        self.keys = {}
+        for image_name in sorted(set(image_names)):
+            source = f'{args.padded_image}/{image_name}'
+            if os.path.exists(source):
+                self.keys[image_name] = hashlib.sha256(f'{manifest.digest(source)}:{params}'.encode()).hexdigest()
+        manifest.save()
+
+    def __contains__(self, image_name):
+        return image_name in self.keys
+
+    def load(self, image_name, load_image):
+        cache_path = f'{self.path}/{self.keys[image_name]}.npy'
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+
+        image = self.prefix(image=load_image(image_name))["image"]
+        ## several workers or runs may fill the same entry, so write to a temporary file first
+        tmp_path = f'{cache_path[:-4]}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, image)
+        os.replace(tmp_path, cache_path)
+        return image
+
+
+class NormalizedInvert(A.ImageOnlyTransform):
+    """
+    A.InvertImg for an image that is already normalized: 255 - x before Normalize is (1 - 2*mean)/std - x after it
+    """
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), always_apply=False, p=0.5):
+        super().__init__(always_apply, p)
+        self.mean, self.std = mean, std
+        self.inverted = (1 - 2 * np.array(mean, dtype=np.float32)) / np.array(std, dtype=np.float32)
+
+    def apply(self, img, **params):
+        return self.inverted - img
+
+    def get_transform_init_args_names(self):
+        return ("mean", "std")
+
+
+@lru_cache(maxsize=None)
+def get_stamp(radius, target_type='diamond'):
+    """
+    pattern stamped on every landmark, cached per radius
+    diamond:  L1 ball of the radius, which is what binary_dilation with the cross structure gives after `radius` iterations
+    gaussian: exp(-d^2 / 2 sigma^2) with sigma = radius/3, cut at the (2*radius+1)^2 window
+    """
+    y, x = np.ogrid[-radius:radius+1, -radius:radius+1]
+    if target_type == 'gaussian':
+        sigma = max(radius, 1) / 3
+        stamp = np.exp(-(y**2 + x**2) / (2 * sigma**2)).astype(np.float32)
+    else:
+        stamp = (np.abs(y) + np.abs(x) <= radius).astype(np.uint8)
+    stamp.setflags(write=False)
+    return stamp
+
+
+def generate_target_masks(coordinates, image_resize, radius, target_type='diamond'):
+    """
+    C x image_resize x image_resize target stack with the stamp written around every (y, x) landmark,
+    uint8 for diamond and float32 for gaussian, so the cost is proportional to the stamp area
+    """
+    stamp = get_stamp(radius, target_type)
+    masks = np.zeros((len(coordinates), image_resize, image_resize), dtype=stamp.dtype)
+
+    for channel, (label_y, label_x) in enumerate(coordinates):
+        label_y = min(max(int(label_y), 0), image_resize - 1)
+        label_x = min(max(int(label_x), 0), image_resize - 1)
+        top, left = label_y - radius, label_x - radius
+        y0, y1 = max(top, 0), min(label_y + radius + 1, image_resize)
+        x0, x1 = max(left, 0), min(label_x + radius + 1, image_resize)
+        masks[channel, y0:y1, x0:x1] = stamp[y0-top:y1-top, x0-left:x1-left]
+
+    return masks
+
+
+def synthesize_target_masks(coordinates, image_resize, radius, target_type='diamond'):
+    """
+    batched torch version of generate_target_masks for --coordinate_targets,
+    B x C x 2 (y, x) coordinates -> B x C x image_resize x image_resize float targets on the device of coordinates
+    """
+    coordinates = coordinates.float().round().clamp(0, image_resize - 1)
+    grid = torch.arange(image_resize, device=coordinates.device, dtype=coordinates.dtype)
+    dy = grid.view(1, 1, -1, 1) - coordinates[..., 0, None, None]
+    dx = grid.view(1, 1, 1, -1) - coordinates[..., 1, None, None]
+
+    if target_type == 'gaussian':
+        sigma = max(radius, 1) / 3
+        window = (dy.abs() <= radius) & (dx.abs() <= radius)
+        return torch.exp(-(dy**2 + dx**2) / (2 * sigma**2)) * window
+    return (dy.abs() + dx.abs() <= radius).float()
+
+
+def to_target_masks(targets, args, device, dilate):
+    """
+    dense float targets on device, synthesized there with the current dilation radius
+    when the loader only ships the landmark coordinates
+    """
+    targets = targets.to(device=device)
+    if args.coordinate_targets:
+        return synthesize_target_masks(targets, args.image_resize, dilate, args.target_type)
+    return targets.float()
+
+
+def compose(transforms, args):
+    if args.coordinate_targets:
+        keypoint_params = A.KeypointParams(format='yx', remove_invisible=False)
+    else:
+        keypoint_params = None
+    return A.Compose(transforms, keypoint_params=keypoint_params, is_check_shapes=False)
+
+
+def get_available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def make_loader(dataset, batch_size, shuffle, num_workers, prefetch_factor=2):
+    ## a ShardDataset shuffles by itself within its buffer
+    shuffle = shuffle and not isinstance(dataset, IterableDataset)
+    kwargs = {}
+    if num_workers > 0:
+        ## workers stay alive across epochs instead of being respawned for every pass over the loader
+        kwargs = {'persistent_workers': True, 'prefetch_factor': prefetch_factor}
+    return DataLoader(
+        dataset, shuffle=shuffle, batch_size=batch_size, num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(), **kwargs
+    )
+
+
+def benchmark_loader(loader, num_batches):
+    """
+    batches per second over num_batches, not counting the first batch which pays the worker startup
+    """
+    iterator = iter(loader)
+    next(iterator)
+    count, start = 0, time.perf_counter()
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        count += 1
+    return count / max(time.perf_counter() - start, 1e-9)
+
+
+def autotune_loader(args, dataset):
+    cpus = get_available_cpus()
+    configs = []
+    for num_workers in sorted({0, min(2, cpus), cpus // 2, cpus}):
+        for prefetch_factor in ((2, 4) if num_workers > 0 else (2,)):
+            configs.append({'num_workers': num_workers, 'prefetch_factor': prefetch_factor})
+
+    results = []
+    for config in configs:
+        loader = make_loader(dataset, args.batch_size, True, **config)
+        throughput = benchmark_loader(loader, args.loader_autotune_batches)
+        print(f"num_workers {config['num_workers']}, prefetch_factor {config['prefetch_factor']}: {throughput:.2f} batches/s")
+        results.append((throughput, config))
+        del loader
+    return max(results, key=lambda result: result[0])[1]
+
+
+def get_loader_key(args):
+    """
+    the tuned config only holds for the same machine and the same kind of loading work
+    """
+    device = torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'cpu'
+    return (
+        f'{platform.node()}:{get_available_cpus()}:{device}:{args.batch_size}:{args.image_resize}:'
+        f'{int(args.image_store)}:{int(args.transform_cache)}:{int(args.coordinate_targets)}:{int(args.use_shards)}'
+    )
+
+
+def get_loader_config(args, dataset):
+    """
+    num_workers and prefetch_factor of the loaders: --loader_workers when given, the cached winner of
+    --loader_autotune for this machine, otherwise 4 workers per device within the available cpus
+    """
+    if args.loader_workers >= 0:
+        return {'num_workers': args.loader_workers, 'prefetch_factor': args.prefetch_factor}
+    if not args.loader_autotune:
+        num_workers = min(get_available_cpus(), 4 * max(torch.cuda.device_count(), 1))
+        return {'num_workers': num_workers, 'prefetch_factor': args.prefetch_factor}
+
+    key = get_loader_key(args)
+    configs = load_loader_configs(args)
+    if key not in configs:
+        print("---------- Starting Tuning DataLoader ----------")
+        config = autotune_loader(args, dataset)
+        ## concurrent folds tune at the same time, so the configs saved meanwhile are read again and
+        ## the file is replaced in one step from a temporary file of this process
+        configs = load_loader_configs(args)
+        configs[key] = config
+        tmp_path = f'{args.loader_config_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(configs, f, indent=4)
+        os.replace(tmp_path, args.loader_config_path)
+        print("---------- Tuning DataLoader Done ----------")
+    return configs[key]
+
+
+def load_loader_configs(args):
+    if not os.path.exists(args.loader_config_path):
+        return {}
+    with open(args.loader_config_path, 'r') as f:
+        return json.load(f)
+
+
+def get_fold_rows(num_rows, args):
+    """
+    train and validation rows of fold args.fold out of args.num_folds. the folds split a permutation of the rows
+    seeded with args.fold_seed, so every run of a cross validation sees the same folds whatever its --seed
+    """
+    folds = np.array_split(np.random.default_rng(args.fold_seed).permutation(num_rows), args.num_folds)
+    train_rows = np.sort(np.concatenate([fold for k, fold in enumerate(folds) if k != args.fold]))
+    return train_rows, np.sort(folds[args.fold])
 
 
 def load_data(args):
@@ -169,15 +507,38 @@ def load_data(args):
     IMAGE_RESIZE = args.image_resize
     BATCH_SIZE = args.batch_size
 
-    train_val_df = pd.read_csv(args.dataset_csv_path)
-    split_point = int((len(train_val_df)*args.dataset_split)/10)
-
-    train_df = train_val_df[:split_point]
-    val_df = train_val_df[split_point:]
-    test_df = pd.read_csv(args.test_dataset_csv_path)
+    if args.use_shards:
+        ## the shards hold the rows of both csvs, so neither the csvs nor the pngs are opened
+        num_train_val = count_shard_rows(args, 'train_val')
+    else:
+        train_val_df = pd.read_csv(args.dataset_csv_path)
+        num_train_val = len(train_val_df)
 
-    if args.augmentation:
-        train_transform = A.Compose([
+    if args.num_folds > 1:
+        train_rows, val_rows = get_fold_rows(num_train_val, args)
+    else:
+        split_point = int((num_train_val*args.dataset_split)/10)
+        train_rows, val_rows = np.arange(split_point), np.arange(split_point, num_train_val)
+
+    if not args.use_shards:
+        train_df = train_val_df.iloc[train_rows]
+        val_df = train_val_df.iloc[val_rows]
+        test_df = pd.read_csv(args.test_dataset_csv_path)
+
+    ## with --gpu_augmentation the random rotation/inversion is applied per batch on the device (augmentation.py)
+    if args.transform_cache and not args.use_shards:
+        ## Resize and Normalize are served by the TransformCache, only the random tail is run online
+        if args.augmentation and not args.gpu_augmentation:
+            train_transform = compose([
+                A.Rotate(limit=5, p=0.3),
+                NormalizedInvert(p=0.3),
+                ToTensorV2(),
+            ], args)
+        else:
+            train_transform = compose([ToTensorV2()], args)
+        val_transform = compose([ToTensorV2()], args)
+    elif args.augmentation and not args.gpu_augmentation:
+        train_transform = compose([
             A.Resize(height=IMAGE_RESIZE, width=IMAGE_RESIZE),
             A.Rotate(limit=5, p=0.3),
             A.InvertImg(p=0.3),
@@ -188,8 +549,8 @@ def load_data(args):
                 max_pixel_value=255.0,
             ),
             ToTensorV2(),
-        ])
-        val_transform = A.Compose([
+        ], args)
+        val_transform = compose([
             A.Resize(height=IMAGE_RESIZE, width=IMAGE_RESIZE),
             A.Normalize(
                 mean=(0.485, 0.456, 0.406),
@@ -197,9 +558,9 @@ def load_data(args):
                 max_pixel_value=255.0,
             ),
             ToTensorV2(),
-        ])
+        ], args)
     else:
-        train_transform = A.Compose([
+        train_transform = compose([
             A.Resize(height=IMAGE_RESIZE, width=IMAGE_RESIZE),
             A.Normalize(
                 mean=(0.485, 0.456, 0.406),
@@ -207,8 +568,8 @@ def load_data(args):
                 max_pixel_value=255.0,
             ),
             ToTensorV2(),
-        ],is_check_shapes=False)
-        val_transform = A.Compose([
+        ], args)
+        val_transform = compose([
             A.Resize(height=IMAGE_RESIZE, width=IMAGE_RESIZE),
             A.Normalize(
                 mean=(0.485, 0.456, 0.406),
@@ -216,31 +577,44 @@ def load_data(args):
                 max_pixel_value=255.0,
             ),
             ToTensorV2(),
-        ],is_check_shapes=False)
-
-    train_dataset = CustomDataset(
-        train_df, args, train_transform
-    )
-    val_dataset = CustomDataset(
-        val_df, args, val_transform
-    )
-    test_dataset = CustomDataset(
-        test_df, args, val_transform
-    )
+        ], args)
+
+    ## one schedule for all datasets, so that the validation targets follow the erosion of the training targets
+    erosion_schedule = ErosionSchedule(args)
+    if args.use_shards:
+        train_dataset = ShardDataset(
+            args, 'train_val', train_rows, train_transform, erosion_schedule, shuffle=True
+        )
+        val_dataset = ShardDataset(
+            args, 'train_val', val_rows, val_transform, erosion_schedule
+        )
+        test_dataset = ShardDataset(
+            args, 'test', range(count_shard_rows(args, 'test')), val_transform, erosion_schedule
+        )
+    else:
+        if args.shared_cache_mb > 0:
+            image_names = pd.concat([train_val_df['image'], test_df['image']])
+            shared_cache = SharedImageCache(args, get_image_names(image_names))
+        else:
+            shared_cache = None
+        train_dataset = CustomDataset(
+            train_df, args, train_transform, erosion_schedule, shared_cache
+        )
+        val_dataset = CustomDataset(
+            val_df, args, val_transform, erosion_schedule, shared_cache
+        )
+        test_dataset = CustomDataset(
+            test_df, args, val_transform, erosion_schedule, shared_cache
+        )
     print('len of train dataset: ', len(train_dataset))
     print('len of val dataset: ', len(val_dataset))
     print('len of test dataset: ', len(test_dataset))
 
-    num_workers = 4 * torch.cuda.device_count()
-    train_loader = DataLoader(
-        train_dataset, shuffle=True, batch_size=BATCH_SIZE, num_workers=num_workers
-    )
-    val_loader = DataLoader(
-        val_dataset, shuffle=False, batch_size=1, num_workers=num_workers
-    )
-    test_loader = DataLoader(
-        test_dataset, shuffle=False, batch_size=1, num_workers=num_workers
-    )
+    loader_config = get_loader_config(args, train_dataset)
+    print(f"num_workers: {loader_config['num_workers']}, prefetch_factor: {loader_config['prefetch_factor']}")
+    train_loader = make_loader(train_dataset, BATCH_SIZE, True, **loader_config)
+    val_loader = make_loader(val_dataset, args.val_batch_size, False, **loader_config)
+    test_loader = make_loader(test_dataset, args.val_batch_size, False, **loader_config)
 
     print("---------- Loading Dataset Done ----------")
 
@@ -256,8 +630,12 @@ def text_to_csv(args, annotation_file, file_type):
                 image_num = line.strip().split(',')[0].split('_')[0]
                 num_of_pixels = int(line.strip().split(',')[1])
 
-                image = cv2.imread(f'{args.padded_image}/{image_name}')
-                resize_value = args.image_resize / image.shape[0]
+                ## size of the saved padded image (the annotation frame) from the sidecar, the image is only read without one
+                image_path = f'{args.padded_image}/{image_name}'
+                metadata = load_pad_metadata(image_path)
+                if metadata is not None: padded_size = metadata.get('stored_size', metadata['size'])
+                else:                    padded_size = cv2.imread(image_path).shape[0]
+                resize_value = args.image_resize / padded_size
                 tmp = []
 
                 for i in range(args.output_channel):
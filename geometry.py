@@ -0,0 +1,127 @@
+"""
+knee alignment geometry on whole cohorts
+
+the angles are computed with NumPy for an N x C x 2 array of (y, x) landmarks in one call, and the landmarks
+an angle is measured between are looked up by name in LANDMARK_SCHEMAS instead of by hardcoded indices.
+tensor_alignment_angles measures the same angles on B x C x 2 tensors for training and validation
+
+usage:
+    python geometry.py --csv_path ./data/dataset.csv --output_channel 6 --output_path ./data/angles.csv
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+
+
+## landmark name -> channel, for every number of annotated landmarks
+LANDMARK_SCHEMAS = {
+    6: {
+        'medial_femur':         0,
+        'upper_implant_left':   1,
+        'upper_implant_center': 2,
+        'lower_implant_left':   3,
+        'lower_implant_center': 4,
+        'medial_tibia':         5,
+    },
+    8: {
+        'medial_femur':         0,
+        'upper_implant_left':   1,
+        'upper_implant_center': 3,
+        'lower_implant_left':   4,
+        'lower_implant_center': 6,
+        'medial_tibia':         7,
+    },
+}
+
+## angle name -> (vertex, first arm, second arm)
+ANGLES = {
+    'LDFA': ('upper_implant_center', 'medial_femur', 'upper_implant_left'),
+    'MPTA': ('lower_implant_center', 'lower_implant_left', 'medial_tibia'),
+    'mHKA': ('upper_implant_center', 'medial_femur', 'medial_tibia'),
+}
+
+
+def get_schema(num_landmarks):
+    if num_landmarks not in LANDMARK_SCHEMAS:
+        raise ValueError(f"no landmark schema for {num_landmarks} landmarks, known are {list(LANDMARK_SCHEMAS)}")
+    return LANDMARK_SCHEMAS[num_landmarks]
+
+
+def vector_angles(vector1, vector2):
+    """
+    N x 2 vectors -> N angles in degrees, zero vectors are replaced by [0.1, 0.1] and the cosine is kept in (-1, 1)
+    """
+    EPSILON = 1e-8
+    vector1 = np.where(np.all(vector1 == 0, axis=-1, keepdims=True), 0.1, vector1)
+    vector2 = np.where(np.all(vector2 == 0, axis=-1, keepdims=True), 0.1, vector2)
+
+    theta = np.sum(vector1 * vector2, axis=-1) / (np.linalg.norm(vector1, axis=-1) * np.linalg.norm(vector2, axis=-1))
+    theta = np.where(theta < -1, -1 + EPSILON, np.where(theta > 1, 1 - EPSILON, theta))
+    return np.degrees(np.arccos(theta))
+
+
+def tensor_vector_angles(vector1, vector2):
+    """
+    torch version of vector_angles, with the same zero vector and out of range cosine handling
+    """
+    EPSILON = 1e-8
+    vector1 = vector1.masked_fill((vector1 == 0).all(dim=-1, keepdim=True), 0.1)
+    vector2 = vector2.masked_fill((vector2 == 0).all(dim=-1, keepdim=True), 0.1)
+
+    theta = (vector1 * vector2).sum(dim=-1) / (vector1.norm(dim=-1) * vector2.norm(dim=-1))
+    theta = theta.masked_fill(theta < -1, -1 + EPSILON).masked_fill(theta > 1, 1 - EPSILON)
+    return torch.rad2deg(torch.acos(theta))
+
+
+def measure_angles(coordinates, schema, angle_function):
+    """
+    the ANGLES of N x C x 2 landmarks as a list of N angles, mHKA as 180 - the angle at the knee
+    """
+    angles = []
+    for name, (vertex, arm1, arm2) in ANGLES.items():
+        center = coordinates[:, schema[vertex]]
+        angle = angle_function(coordinates[:, schema[arm1]] - center, coordinates[:, schema[arm2]] - center)
+        angles.append(180 - angle if name == 'mHKA' else angle)
+    return angles
+
+
+def alignment_angles(coordinates, schema=None):
+    """
+    N x C x 2 (y, x) landmarks -> N x 3 LDFA, MPTA, mHKA (reported as 180 - the angle at the knee)
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if schema is None:
+        schema = get_schema(coordinates.shape[1])
+    return np.stack(measure_angles(coordinates, schema, vector_angles), axis=-1)
+
+
+def tensor_alignment_angles(coordinates, schema=None, angle_function=tensor_vector_angles):
+    """
+    B x C x 2 (y, x) tensor -> B x 3 LDFA, MPTA, mHKA, angle_function can be swapped for a differentiable one
+    """
+    if schema is None:
+        schema = get_schema(coordinates.shape[1])
+    return torch.stack(measure_angles(coordinates, schema, angle_function), dim=-1)
+
+
+def cohort_angles(args):
+    df = pd.read_csv(args.csv_path)
+    columns = [f'label_{k}_{axis}' for k in range(args.output_channel) for axis in ('y', 'x')]
+    coordinates = df[columns].to_numpy(dtype=np.float64).reshape(len(df), args.output_channel, 2)
+
+    angles = pd.DataFrame(alignment_angles(coordinates), columns=list(ANGLES))
+    angles.insert(0, 'image', df['image'])
+    angles.to_csv(args.output_path, index=False)
+    print(f"angles of {len(df)} cases saved in {args.output_path}")
+    print(angles[list(ANGLES)].describe().loc[['mean', 'std', 'min', 'max']].round(3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv_path', type=str, default="./data/dataset.csv", help='csv with an image column and label_{k}_y / label_{k}_x columns')
+    parser.add_argument('--output_channel', type=int, default=6, help='number of landmarks in the csv')
+    parser.add_argument('--output_path', type=str, default="./data/angles.csv", help='path of the csv with the angles of every case')
+    args = parser.parse_args()
+    cohort_angles(args)
@@ -0,0 +1,114 @@
+"""
+packed, memory-mapped uint8 image store for CustomDataset
+
+every padded image is resized to image_resize once and packed into one contiguous N x H x W uint8 .npy file,
+next to an index of image name -> offset with the pad/scale sidecar of every image.
+the file is opened with np.memmap, so the dataloader workers read zero-copy slices
+and share the page cache instead of each decoding and resizing the pngs every epoch
+"""
+
+import os
+import json
+import cv2
+import numpy as np
+
+from functools import partial
+from glob import glob
+
+from preprocess import run_in_pool, write_error_manifest, load_pad_metadata
+
+
+def get_store_paths(args):
+    images_path = f'{args.image_store_path}/images_{args.image_resize}.npy'
+    index_path = f'{args.image_store_path}/index_{args.image_resize}.json'
+    return images_path, index_path
+
+
+def pack_image(task, images_path, image_resize):
+    """
+    resize a padded image and write it into its offset of the store, used as the worker of build_image_store
+    """
+    offset, image_path = task
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    ## same interpolation as A.Resize
+    image = cv2.resize(image, (image_resize, image_resize), interpolation=cv2.INTER_LINEAR)
+
+    images = np.load(images_path, mmap_mode='r+')
+    images[offset] = image
+    images.flush()
+
+    return {'outputs': [images_path]}
+
+
+def compact_image_store(images_path, image_paths, records, image_resize):
+    """
+    rewrite the store with only the rows of the images that were packed, returns their paths in store order
+    """
+    offsets = sorted(record['task'][0] for record in records if record['status'] == 'done')
+    images = np.load(images_path, mmap_mode='r')
+    compacted = np.lib.format.open_memmap(
+        f'{images_path}.{os.getpid()}.tmp', mode='w+', dtype=np.uint8, shape=(len(offsets), image_resize, image_resize)
+    )
+    for row, offset in enumerate(offsets):
+        compacted[row] = images[offset]
+    compacted.flush()
+    del images, compacted
+    os.replace(f'{images_path}.{os.getpid()}.tmp', images_path)
+    return [image_paths[offset] for offset in offsets]
+
+
+def build_image_store(args):
+    print("---------- Starting Building Image Store ----------")
+    if not os.path.exists(f'{args.image_store_path}'):
+        os.mkdir(f'{args.image_store_path}')
+    images_path, index_path = get_store_paths(args)
+    image_paths = sorted(glob(f'{args.padded_image}/*_pad.png'))
+
+    images = np.lib.format.open_memmap(
+        images_path, mode='w+', dtype=np.uint8, shape=(len(image_paths), args.image_resize, args.image_resize)
+    )
+    del images
+
+    worker = partial(pack_image, images_path=images_path, image_resize=args.image_resize)
+    records = run_in_pool(worker, list(enumerate(image_paths)), args, desc='image store')
+    if write_error_manifest(records, 'image_store', args):
+        ## the rows of failed images are empty, they are left out so that CustomDataset does not serve black images
+        image_paths = compact_image_store(images_path, image_paths, records, args.image_resize)
+
+    index = {
+        'image_resize': args.image_resize,
+        'names':        [image_path.split('/')[-1] for image_path in image_paths],
+        'metadata':     {image_path.split('/')[-1]: load_pad_metadata(image_path) for image_path in image_paths},
+    }
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f"{len(image_paths)} images packed into {images_path}")
+    print("---------- Building Image Store Done ----------\n")
+
+
+class ImageStore():
+    def __init__(self, args):
+        self.images_path, index_path = get_store_paths(args)
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.offsets = {name: offset for offset, name in enumerate(index['names'])}
+        self.metadata = index['metadata']
+        self._images = None
+
+    def __getstate__(self):
+        ## the memmap is opened again in every dataloader worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode='r')
+        return self._images
+
+    def __contains__(self, name):
+        return name in self.offsets
+
+    def __getitem__(self, name):
+        return self.images[self.offsets[name]]
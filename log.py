@@ -9,7 +9,11 @@ def initiate_wandb(args):
                 entity=f"{args.wandb_entity}",
             )
             args.angle_loss_weight = int(wandb.config['angle_loss_weight'])
-            args.batch_size        = int(wandb.config['batch_size'])
+            ## sweeps over the effective batch size leave the per-step batch to --auto_batch_size
+            if 'batch_size' in wandb.config:
+                args.batch_size           = int(wandb.config['batch_size'])
+            if 'effective_batch_size' in wandb.config:
+                args.effective_batch_size = int(wandb.config['effective_batch_size'])
             # args.decoder_channel   = list(wandb.config['decoder_channel'])
             args.learning_rate     = int(wandb.config['learning_rate'])
             args.seed              = int(wandb.config['seed'])
@@ -0,0 +1,45 @@
+"""
+differentiable angle loss
+
+LDFA, MPTA and mHKA are measured between the soft-argmax coordinates of the predicted heatmaps, so unlike the
+argmax angles of calculate_angles the loss has a gradient, and the whole batch stays on the training device
+
+reference:
+    soft-argmax:
+        https://arxiv.org/abs/1711.08229
+"""
+
+import torch
+import torch.nn as nn
+
+from utility import soft_argmax_landmarks
+from geometry import get_schema, tensor_alignment_angles
+
+
+class AngleLoss(nn.Module):
+    def __init__(self, args, eps=1e-6):
+        super(AngleLoss, self).__init__()
+        self.args = args
+        self.beta = args.soft_argmax_beta
+        self.eps = eps
+        self.mse = nn.MSELoss()
+
+    def angle(self, vector1, vector2):
+        ## eps under the square root and the clamp keep the norm and acos gradients finite
+        norm = torch.sqrt((vector1 ** 2).sum(dim=-1) * (vector2 ** 2).sum(dim=-1) + self.eps)
+        cosine = ((vector1 * vector2).sum(dim=-1) / norm).clamp(-1 + self.eps, 1 - self.eps)
+        return torch.rad2deg(torch.acos(cosine))
+
+    def angles(self, coordinates):
+        """
+        B x C x 2 coordinates -> B x 3 LDFA, MPTA, mHKA
+        """
+        return tensor_alignment_angles(coordinates, get_schema(self.args.output_channel), self.angle)
+
+    def forward(self, predictions, coordinates):
+        """
+        predictions: B x C x H x W heatmap logits
+        coordinates: B x C x 2 (y, x) annotated landmarks
+        """
+        predicted = soft_argmax_landmarks(predictions, self.beta)
+        return self.mse(self.angles(predicted), self.angles(coordinates.float()))
@@ -18,8 +18,11 @@ import torch.optim as optim
 import preprocess
 from argument import arg_as_list
 from dataset import load_data, create_dataset
+from image_store import build_image_store
+from shards import export_shards
 from model import get_model, get_pretrained_model
-from train import train
+from loss import AngleLoss
+from train import train, find_batch_size, get_accumulation_steps
 from log import initiate_wandb
 
 
@@ -28,30 +31,36 @@ def main(args):
     initiate_wandb(args)
 
     ## data preprocessing
-    if args.data_preprocessing:
+    if args.data_preprocessing and args.stream_preprocess:
+        _, original_annotation_list = preprocess.get_dataset(args)
+        preprocess.stream_preprocess(original_annotation_list, args)
+    elif args.data_preprocessing:
         useful_dicom_list, original_annotation_list = preprocess.get_dataset(args)
-        print(original_annotation_list)
-        exit()
-        useful_dicom_path_list = preprocess.get_path(useful_dicom_list, args)
-        
+        if args.retry_failed:
+            useful_dicom_path_list = preprocess.load_failed_tasks('dicom2png', args)
+        else:
+            useful_dicom_path_list = preprocess.get_path(useful_dicom_list, args)
+
         preprocess.dicom2png(useful_dicom_path_list, args)
         preprocess.dicom2png_overlay(original_annotation_list, args)
 
     ## pad the original image & get annotation coordintaes
-    if args.pad_image:
-        preprocess.pad_original_image(args)
-        preprocess.pad_overlaid_image(args)
+    if args.pad_image and not args.stream_preprocess:
+        preprocess.pad_images(args)
         ## after padding, annotation should be manually done by using ./create data/select_point.py
 
     ## create dataset from padded images & annotation text file
     if args.create_dataset: 
         create_dataset(args)
 
-    ## load data into a form that can be fed into the model
-    if not args.progressive_erosion:
-        train_loader, val_loader, _ = load_data(args)
-    else:
-        train_loader, val_loader = 0, 0
+    ## pack the padded images resized to image_resize into one memory-mapped file
+    if args.build_image_store:
+        build_image_store(args)
+
+    ## pack the dataset into a few sequential shards that can be copied to a fresh node
+    if args.export_shards:
+        export_shards(args)
+
     DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
     print(f'Torch is running on {DEVICE}')
 
@@ -74,9 +83,19 @@ def main(args):
         weight = 1
         loss_fn_pixel = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([weight], device=DEVICE))
     loss_fn_geometry = nn.MSELoss()
-    loss_fn_angle = nn.MSELoss()
+    loss_fn_angle = AngleLoss(args)
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
 
+    ## largest per-step batch that fits on the device, the rest of the effective batch is accumulated
+    if args.auto_batch_size:
+        args.effective_batch_size = args.effective_batch_size or args.batch_size
+        args.batch_size = find_batch_size(args, model, DEVICE, loss_fn_pixel, loss_fn_geometry, loss_fn_angle)
+    if args.effective_batch_size:
+        print(f"batch size {args.batch_size}, {get_accumulation_steps(args)} accumulation steps for an effective batch size of {args.effective_batch_size}")
+
+    ## load data into a form that can be fed into the model
+    train_loader, val_loader, _ = load_data(args)
+
     ## train model
     train(
         args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, 
@@ -84,7 +103,7 @@ def main(args):
     )
 
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
 
     ## boolean arguments
@@ -101,20 +120,46 @@ if __name__ == '__main__':
     parser.add_argument('--progressive_erosion', action='store_true', help='whether to use progressive erosion')
     parser.add_argument('--progressive_weight', action='store_true', help='whether to use progressive weight')
     parser.add_argument('--pretrained', action='store_true', help='whether to pretrained model')
+    parser.add_argument('--amp', action='store_true', help='whether to use automatic mixed precision, float16 on cuda and bfloat16 on cpu')
+    parser.add_argument('--auto_batch_size', action='store_true', help='whether to probe the largest per-step batch size that fits on the device and accumulate the rest')
     parser.add_argument('--wandb', action='store_true', help='whether to use wandb or not')
     parser.add_argument('--wandb_sweep', action='store_true', help='whether to use wandb or not')
     parser.add_argument('--no_image_save', action='store_true', help='whether to save image or not')
+    parser.add_argument('--build_image_store', action='store_true', help='whether to pack the padded images into the image store')
+    parser.add_argument('--export_shards', action='store_true', help='whether to pack the dataset into shards for a fast cold start')
+    parser.add_argument('--coordinate_targets', action='store_true', help='whether to load only the landmark coordinates and synthesize the targets on the device')
+    parser.add_argument('--gpu_augmentation', action='store_true', help='whether to apply the random augmentation per batch on the training device instead of in the loader workers')
+    parser.add_argument('--image_store', action='store_true', help='whether to read the images from the packed image store')
+    parser.add_argument('--use_shards', action='store_true', help='whether to stream the dataset from the exported shards')
+    parser.add_argument('--loader_autotune', action='store_true', help='whether to benchmark a few dataloader configs and reuse the fastest one on this machine')
+    parser.add_argument('--transform_cache', action='store_true', help='whether to read the resized and normalized images from the transform cache')
+    parser.add_argument('--stream_preprocess', action='store_true', help='whether to go from dicom to padded image in memory without intermediate pngs')
+    parser.add_argument('--save_debug_images', action='store_true', help='whether to save the intermediate images of the streaming preprocess')
+    parser.add_argument('--retry_failed', action='store_true', help='whether to only convert the dicoms that failed in the error manifest')
+    parser.add_argument('--rebuild_dicom_index', action='store_true', help='whether to walk the dicom archive again even if the index exists')
+    parser.add_argument('--force_preprocess', action='store_true', help='whether to preprocess even the inputs that are up to date in the manifest')
 
     ## get dataset
     parser.add_argument('--excel_path', type=str, default="./xlsx/dataset.xlsx", help='path to dataset excel file')
 
     ## data preprocessing
     parser.add_argument('--dicom_data_path', type=str, default="./data/dicom_data", help='path to the dicom dataset')
+    parser.add_argument('--dicom_index_path', type=str, default="./data/dicom_index.json", help='path to save the index of the dicom dataset')
     parser.add_argument('--dicom_to_png_path', type=str, default="./data/dicom_to_png", help='path to save dicom to png preprocessed data')
     parser.add_argument('--overlaid_image', type=str, default="./data/overlay_image_to_label", help='path to all the data from overlaying')
     parser.add_argument('--overlaid_image_only', type=str, default="./data/overlay_only", help='path to save overlaid data')
     parser.add_argument('--overlaid_padded_image', type=str, default="./data/overlay_padded_image", help='path to save padded data')
     parser.add_argument('--padded_image', type=str, default="./data/padded_image", help='path to save padded data')
+    parser.add_argument('--image_store_path', type=str, default="./data/image_store", help='path to save the packed image store')
+    parser.add_argument('--shard_path', type=str, default="./data/shards", help='path to save the dataset shards')
+    parser.add_argument('--loader_config_path', type=str, default="./data/loader_config.json", help='path to save the tuned dataloader config of every machine')
+    parser.add_argument('--transform_cache_path', type=str, default="./data/transform_cache", help='path to save the resized and normalized images')
+    parser.add_argument('--manifest_path', type=str, default="./data/preprocess_manifest.json", help='path to save the incremental preprocessing manifest')
+    parser.add_argument('--preprocess_resize', type=int, default=0, help='largest size of the padded images saved by the streaming preprocess, smaller ones are kept (0: full resolution)')
+    parser.add_argument('--error_manifest', type=str, default="./data/error_manifest.json", help='path to save the failed preprocessing tasks')
+    parser.add_argument('--preprocess_workers', type=int, default=0, help='number of processes for preprocessing (0: all cpus)')
+    parser.add_argument('--preprocess_chunksize', type=int, default=16, help='number of tasks submitted to a process at once')
+    parser.add_argument('--preprocess_retries', type=int, default=1, help='number of retries for failed preprocessing tasks')
 
     ## hyperparameters - data
     parser.add_argument('--dataset_path', type=str, default="./data/dataset", help='dataset path')
@@ -124,12 +169,28 @@ if __name__ == '__main__':
     parser.add_argument('--annotation_text_name', type=str, default="annotation_label8.txt", help='annotation text file name')
     parser.add_argument('--test_annotation_text_name', type=str, default="annotation_label6_test.txt", help='annotation text file name')
     parser.add_argument('--dataset_split', type=int, default=9, help='dataset split ratio')
+    parser.add_argument('--num_folds', type=int, default=0, help='number of cross validation folds, 0 to use dataset_split')
+    parser.add_argument('--fold', type=int, default=0, help='cross validation fold used for validation')
+    parser.add_argument('--fold_seed', type=int, default=0, help='seed of the cross validation folds')
     parser.add_argument('--dilate', type=int, default=2, help='dilate iteration')
+    parser.add_argument('--target_type', type=str, default="diamond", choices=["diamond", "gaussian"], help='pattern of the target around every landmark')
     parser.add_argument('--dilation_decrease', type=int, default=5, help='dilation decrease in progressive erosion')
     parser.add_argument('--dilation_epoch', type=int, default=50, help='dilation per epoch')
     parser.add_argument('--image_path', type=str, default="./overlay_only", help='path to save overlaid data')
     parser.add_argument('--image_resize', type=int, default=512, help='image resize value')
     parser.add_argument('--batch_size', type=int, default=24, help='batch size')
+    parser.add_argument('--effective_batch_size', type=int, default=0, help='batch size of every optimizer step, reached by accumulating gradients, 0 for batch_size')
+    parser.add_argument('--max_batch_size_probe', type=int, default=64, help='largest per-step batch size tried by --auto_batch_size')
+    parser.add_argument('--val_batch_size', type=int, default=8, help='batch size of validation and test')
+    parser.add_argument('--landmark_decoder', type=str, default='argmax', choices=['argmax', 'soft_argmax'], help='how the landmark coordinates are decoded from the heatmaps')
+    parser.add_argument('--subpixel', action='store_true', help='whether to refine the decoded landmarks to sub-pixel precision')
+    parser.add_argument('--soft_argmax_beta', type=float, default=1.0, help='inverse temperature of the soft-argmax of the angle loss and the soft_argmax decoder')
+    parser.add_argument('--loader_workers', type=int, default=-1, help='number of dataloader workers, -1 to choose them from the available cpus')
+    parser.add_argument('--shared_cache_mb', type=int, default=0, help='memory budget in MB of the decoded images shared by the dataloader workers, 0 to disable')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='number of batches loaded in advance by each dataloader worker')
+    parser.add_argument('--shard_size', type=int, default=256, help='number of images per dataset shard')
+    parser.add_argument('--shuffle_buffer', type=int, default=64, help='number of items shuffled together when streaming the shards')
+    parser.add_argument('--loader_autotune_batches', type=int, default=10, help='number of batches timed per dataloader config by --loader_autotune')
     parser.add_argument('--delete_method', type=str, default="", help='how to delete unnecessary data in the xray images ["", "letter", "box"]')
     
     ## hyperparameters - model
@@ -152,5 +213,9 @@ if __name__ == '__main__':
     parser.add_argument('--wandb_entity', type=str, default="yehyun-suh", help='wandb entity name')
     parser.add_argument('--wandb_name', type=str, default="temporary", help='wandb name')
 
-    args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+"""
+incremental preprocessing manifest
+
+every input file is fingerprinted by path, size, mtime and the sha256 of its content,
+every artifact records which inputs (with their hashes) and which parameters produced which outputs.
+a stage only has to process the inputs whose artifact is missing or out of date.
+
+the content hash is only recomputed when the size or the mtime of a file changed
+"""
+
+import os
+import json
+import hashlib
+
+
+def file_digest(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': file_digest(path)}
+
+
+class PreprocessManifest():
+    def __init__(self, path):
+        self.path = path
+        self.files, self.artifacts = {}, {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+            self.files, self.artifacts = manifest['files'], manifest['artifacts']
+
+    def is_stale(self, path):
+        """
+        whether the content hash of path has to be (re)computed
+        """
+        entry = self.files.get(path)
+        if entry is None:
+            return True
+        stat = os.stat(path)
+        return entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns
+
+    def update(self, path, entry):
+        self.files[path] = entry
+
+    def digest(self, path):
+        if self.is_stale(path):
+            self.update(path, fingerprint(path))
+        return self.files[path]['sha256']
+
+    def is_up_to_date(self, stage, key, inputs, params):
+        """
+        whether the artifact of key was produced by the current content of inputs with the same params,
+        and all of its outputs still exist
+        """
+        artifact = self.artifacts.get(f'{stage}:{key}')
+        if artifact is None or artifact['params'] != params:
+            return False
+        try:
+            digests = {path: self.digest(path) for path in inputs}
+        except FileNotFoundError:
+            return False
+        if artifact['inputs'] != digests:
+            return False
+        return all(os.path.exists(output) for output in artifact['outputs'])
+
+    def record(self, stage, key, inputs, params, outputs, info=None):
+        """
+        info holds what the stage found out about the inputs, e.g. the dicom triage of dicom2png
+        """
+        self.artifacts[f'{stage}:{key}'] = {
+            'inputs':  {path: self.digest(path) for path in inputs},
+            'params':  params,
+            'outputs': outputs,
+            'info':    info,
+        }
+
+    def save(self):
+        ## write to a temporary file first so that an interrupted run does not corrupt the manifest,
+        ## named per process since concurrent folds save the same manifest
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.files, 'artifacts': self.artifacts}, f)
+        os.replace(tmp_path, self.path)
@@ -103,7 +103,8 @@ def get_pretrained_model(args, DEVICE):
         encoder_weights = 'imagenet', 
         encoder_depth   = args.encoder_depth,
         classes         = args.output_channel, 
-        activation      = 'sigmoid',
+        ## the sigmoid is applied in float32 outside of autocast, where probabilities are needed
+        activation      = None,
         decoder_channels= args.decoder_channel,
     )
 
@@ -5,13 +5,34 @@ import os
 import cv2
 import torch
 import random
+import json
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from glob import glob
 from tqdm import tqdm
 from PIL import Image
 
-def get_dataset(args):
+from manifest import PreprocessManifest, fingerprint
+
+def read_excel_cached(args):
+    """
+    read args.excel_path through a parquet cache next to it, the cache is rebuilt when the excel file is newer
+    """
+    cache_path = f'{os.path.splitext(args.excel_path)[0]}.parquet'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(args.excel_path):
+        return pd.read_parquet(cache_path)
+
     df = pd.read_excel(f'{args.excel_path}')
+    try:
+        df.to_parquet(cache_path)
+    except (ImportError, TypeError, ValueError) as e:
+        ## no parquet engine installed or columns parquet can not hold, just go without the cache
+        print(f'Excel cache is not saved -> {e}')
+    return df
+
+def get_dataset(args):
+    df = read_excel_cached(args)
     df = df[df['annotation_image'].notna()]
     df = df.fillna(0)
     val_list = df.values.tolist()
@@ -24,222 +45,350 @@ def get_dataset(args):
 
     return useful_dicom, val_list
 
-def get_path(useful_dicoms, args):
-    tmp_dicom_lists = glob(f'{args.dicom_data_path}/*')
-    tmp, tmp2, tmp3, dicom_lists = [], [], [], []
-    for dicom_list in tmp_dicom_lists:
-        tmp.append(glob(f'{dicom_list}/*')[0])
-    for dicom_list in tmp:
-        tmp2.append(glob(f'{dicom_list}/*')[0])
-    for dicom_list in tmp2:
-        tmp3.append(glob(f'{dicom_list}/*'))
-    for list in tmp3:
-        for dicom_list in list:
-            dicom_lists.append(glob(f'{dicom_list}/*'))
-    
-    ## extract only useful paths from dicom_lists
-    useful_dicoms_list = []
-
-    for i in range(len(dicom_lists)):
-        if dicom_lists[i][0].split("/")[-1] in useful_dicoms:
-            useful_dicoms_list.append(dicom_lists[i][0])
-
-    return sorted(useful_dicoms_list)
+def build_dicom_index(args, useful_dicoms=()):
+    """
+    walk args.dicom_data_path once with os.scandir and map every file name (the SOP identifier) to its path
+    the index is saved to args.dicom_index_path so that later runs do not walk the archive again,
+    together with the useful dicoms that were not found and the mtime of every directory of the archive,
+    so that missing dicoms only trigger a new walk once something in the archive changed
+    """
+    files, mtimes, directories = {}, {}, [args.dicom_data_path]
+    while directories:
+        directory = directories.pop()
+        mtimes[directory] = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    ## the same name in several directories resolves to the same path on every run
+                    if entry.name not in files or entry.path < files[entry.name]:
+                        files[entry.name] = entry.path
+
+    index = {'files': files, 'missing': sorted(set(useful_dicoms) - files.keys()), 'directories': mtimes}
+    with open(args.dicom_index_path, 'w') as f:
+        json.dump(index, f)
+    return index
+
+def archive_changed(index):
+    for directory, mtime in index.get('directories', {}).items():
+        if not os.path.isdir(directory) or os.stat(directory).st_mtime_ns != mtime:
+            return True
+    return 'directories' not in index
 
-def get_pixel_array(dcm_info, path, data_name, count, args):
-    dcm_img = dcm_info.pixel_array
-
-    # # original image
-    # show_img = Image.fromarray(dcm_img)
-
-    # # normalized image
-    norm = (dcm_img - np.min(dcm_img)) / (np.max(dcm_img) - np.min(dcm_img))
-    norm_img = np.uint8(norm*255)
-    show_img = Image.fromarray(norm_img)
-
-    # show_img.save(f'{args.dicom_to_png_path}/original_image/{path[0]}_{path[1]}_{path[2]}_{count}_{data_name}.png')
-    show_img.save(f'{args.dicom_to_png_path}/original_image/{path[0]}_{path[1]}_{path[2]}_{path[3]}_{data_name}.png')
-    count += 1
-    # show_img.show()
-    return count
-
-def get_overlay_array(dcm_info, path, data_name, count, args):
+def get_path(useful_dicoms, args):
+    useful_dicoms = set(useful_dicoms)
+    if args.rebuild_dicom_index or not os.path.exists(args.dicom_index_path):
+        index = build_dicom_index(args, useful_dicoms)
+    else:
+        with open(args.dicom_index_path, 'r') as f:
+            index = json.load(f)
+        ## walk again for dicoms that were never looked for, or when a directory of the archive changed
+        ## (a dicom added to a directory changes its mtime, a new directory changes the mtime of its parent)
+        if useful_dicoms - index['files'].keys() - set(index['missing']) or archive_changed(index):
+            index = build_dicom_index(args, useful_dicoms)
+
+    files = index['files']
+    missing = useful_dicoms - files.keys()
+    if missing:
+        print(f'{len(missing)} dicoms in {args.excel_path} are not in {args.dicom_data_path}')
+
+    return sorted(files[name] for name in useful_dicoms & files.keys())
+
+def normalize_to_uint8(array):
+    """
+    min-max normalization into uint8, done in place on a single float32 buffer
+    so that 4k x 2k long-leg films do not need several float64 temporaries
+    """
+    norm = array.astype(np.float32)
+    minimum, maximum = norm.min(), norm.max()
+    norm -= minimum
+    if maximum > minimum:
+        norm *= 255 / (maximum - minimum)
+    return norm.astype(np.uint8)
+
+def get_pixel_array(dcm_info, save_path):
+    show_img = Image.fromarray(normalize_to_uint8(dcm_info.pixel_array))
+    show_img.save(save_path)
+
+def get_overlay_array(dcm_info, save_path):
     dcm_img = dcm_info.overlay_array(0x6000)
-    for i in range(len(dcm_img)):
-        for j in range(len(dcm_img[i])):
-            if dcm_img[i][j] == 1:
-                dcm_img[i][j] = 254
+    dcm_img[dcm_img == 1] = 254
     show_img = Image.fromarray(dcm_img)
+    show_img.save(save_path)
+
+def read_dicom_header(dicom_path):
+    """
+    read only the header of a dicom, large values such as pixel data and overlay data are deferred
+    and read from the file only when they are accessed
+    """
+    return pydicom.dcmread(dicom_path, force=True, defer_size='1 KB')
+
+def triage_dicom(dcm_info):
+    """
+    classify a dicom as 'image', 'overlay' or 'unusable' from its header only,
+    scout/localizer series and dicoms without pixel or overlay data are unusable
+    """
+    image_type = dcm_info.get('ImageType', [])
+    image_type = [image_type] if isinstance(image_type, str) else [str(value) for value in image_type]
+
+    info = {
+        'rows':           int(dcm_info.get('Rows', 0) or 0),
+        'columns':        int(dcm_info.get('Columns', 0) or 0),
+        'bits_allocated': int(dcm_info.get('BitsAllocated', 0) or 0),
+        'bits_stored':    int(dcm_info.get('BitsStored', 0) or 0),
+    }
+
+    if 'LOCALIZER' in [value.upper() for value in image_type]:
+        kind = 'unusable'
+    elif 'PixelData' in dcm_info and info['rows'] and info['columns']:
+        kind = 'image'
+    elif (0x6000, 0x3000) in dcm_info:
+        kind = 'overlay'
+        info['rows'] = int(dcm_info[0x6000,0x0010].value) if (0x6000, 0x0010) in dcm_info else 0
+        info['columns'] = int(dcm_info[0x6000,0x0011].value) if (0x6000, 0x0011) in dcm_info else 0
+        info['bits_allocated'], info['bits_stored'] = 1, 1
+    else:
+        kind = 'unusable'
+
+    info['kind'] = kind
+    return info
+
+def convert_dicom(dicom_path, output_path):
+    """
+    convert a single dicom into png, used as the worker of dicom2png
+    the dicom is triaged from its header, and pixel/overlay data is only decoded when it is converted:
+    dicom with pixel data goes to original_image, overlay-only dicom goes to annotation_image
+    """
+    path = dicom_path.split('/')[2:6]
+    data_name = dicom_path.split('/')[-1]
+    file_name = f'{path[0]}_{path[1]}_{path[2]}_{path[3]}_{data_name}.png'
+    dcm_info = read_dicom_header(dicom_path)
+    info = triage_dicom(dcm_info)
+
+    if info['kind'] == 'image':
+        save_path = f'{output_path}/original_image/{file_name}'
+        get_pixel_array(dcm_info, save_path)
+    elif info['kind'] == 'overlay':
+        save_path = f'{output_path}/annotation_image/{file_name}'
+        get_overlay_array(dcm_info, save_path)
+    else:
+        return {'info': info, 'outputs': []}
+
+    return {'info': info, 'outputs': [save_path]}
+
+def get_num_workers(args):
+    if args.preprocess_workers > 0:
+        return args.preprocess_workers
+    return os.cpu_count() or 1
+
+def _run_task(worker, task):
+    try:
+        record = worker(task)
+        record['status'] = 'done'
+    except Exception as e:
+        record = {'status': 'failed', 'error_type': type(e).__name__, 'error': str(e)}
+    record['task'] = task
+    return record
+
+def run_in_pool(worker, tasks, args, desc=None):
+    """
+    run worker over tasks on a process pool with chunked task submission
+    failed tasks are retried up to args.preprocess_retries times,
+    the records of tasks that still fail are returned with status 'failed'
+    """
+    num_workers = get_num_workers(args)
+    run = partial(_run_task, worker)
+    records, failed, pending = [], [], list(tasks)
+
+    for attempt in range(args.preprocess_retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            print(f"Retrying {len(pending)} failed tasks (attempt {attempt + 1})")
+
+        if num_workers == 1:
+            results = map(run, pending)
+            results = tqdm(results, total=len(pending), desc=desc)
+            failed = _collect(results, records, attempt)
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = executor.map(run, pending, chunksize=args.preprocess_chunksize)
+                results = tqdm(results, total=len(pending), desc=desc)
+                failed = _collect(results, records, attempt)
+        pending = [record['task'] for record in failed]
+
+    return records + failed
+
+def _collect(results, records, attempt):
+    failed = []
+    for record in results:
+        record['attempts'] = attempt + 1
+        if record['status'] == 'failed': failed.append(record)
+        else:                            records.append(record)
+    return failed
+
+def write_error_manifest(records, stage, args):
+    """
+    save the failed records of a stage into the error manifest (json),
+    the other stages already in the manifest are kept
+    """
+    manifest = {}
+    if os.path.exists(args.error_manifest):
+        with open(args.error_manifest, 'r') as f:
+            manifest = json.load(f)
+
+    failed = [record for record in records if record['status'] == 'failed']
+    manifest[stage] = failed
+    with open(args.error_manifest, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    if failed:
+        print(f"{len(failed)} failed on {stage}, see {args.error_manifest}")
+    return failed
+
+def load_failed_tasks(stage, args):
+    if not os.path.exists(args.error_manifest):
+        return []
+    with open(args.error_manifest, 'r') as f:
+        manifest = json.load(f)
+    return [record['task'] for record in manifest.get(stage, [])]
+
+def refresh_digests(manifest, paths, args):
+    """
+    (re)hash the files whose size or mtime changed since the last run on the process pool
+    """
+    stale_paths = [path for path in paths if os.path.exists(path) and manifest.is_stale(path)]
+    if not stale_paths:
+        return
+    for record in run_in_pool(fingerprint, stale_paths, args, desc='fingerprint'):
+        if record['status'] == 'done':
+            manifest.update(record['task'], {key: record[key] for key in ['size', 'mtime', 'sha256']})
+
+def run_stage(stage, worker, tasks, params, args, get_inputs=lambda task: [task], get_key=str):
+    """
+    run worker only over the tasks whose inputs or params changed since the last run of the stage
+    (every task with --force_preprocess), and record the produced outputs in the manifest
+    """
+    manifest = PreprocessManifest(args.manifest_path)
+    inputs = {get_key(task): get_inputs(task) for task in tasks}
+    refresh_digests(manifest, sorted({path for paths in inputs.values() for path in paths}), args)
+
+    if args.force_preprocess:
+        pending = list(tasks)
+    else:
+        pending = [
+            task for task in tasks 
+            if not manifest.is_up_to_date(stage, get_key(task), inputs[get_key(task)], params)
+        ]
+    print(f"{stage}: {len(tasks)-len(pending)} up to date, {len(pending)} to process")
+
+    records = run_in_pool(worker, pending, args, desc=stage)
+    for record in records:
+        if record['status'] == 'done':
+            key = get_key(record['task'])
+            manifest.record(stage, key, inputs[key], params, record['outputs'], record.get('info'))
+    manifest.save()
+    write_error_manifest(records, stage, args)
+
+    return records
+
+def place_overlay(original_shape, overlay_arr, origin):
+    """
+    place the 0x6000 overlay plane on a canvas of the original image size
+    origin is the 1-based (row, column) of (0x6000,0x0050)
+    when the overlay is not shorter than the original, it starts from the top and the lower part is cropped
+    returns uint8 label image which is 255 on the overlay and 0 elsewhere
+    """
+    height, width = original_shape[:2]
+    top = origin[0] - 1 if height > overlay_arr.shape[0] else 0
+    left = origin[1] - 1
+    rows = max(min(overlay_arr.shape[0], height - top), 0)
+    cols = max(min(overlay_arr.shape[1], width - left), 0)
+
+    label = np.zeros((height, width), dtype=np.uint8)
+    label[top:top+rows, left:left+cols] = (overlay_arr[:rows, :cols] == 1) * np.uint8(255)
+    return label
+
+def get_study_paths(original_annotation):
+    split_original = original_annotation[0].split("_")
+    split_annotation = original_annotation[-1].split("_")
+
+    original_path = f"./data/{split_original[0]}/{split_original[1]}/{split_original[2]}/{split_original[3]}/{split_original[4]}"
+    annotation_path = f"./data/{split_annotation[0]}/{split_annotation[1]}/{split_annotation[2]}/{split_annotation[3]}/{split_annotation[4]}"
+    return original_path, annotation_path
+
+def overlay_study(task, overlaid_image, overlaid_image_only):
+    """
+    overlay the annotation dicom on the original dicom, used as the worker of overlay_two_images
+    the decoded arrays are reused in memory, only the results are written
+    """
+    i, original_annotation = task
+    original_path, annotation_path = get_study_paths(original_annotation)
+
+    original_dcm = pydicom.dcmread(original_path)
+    annotation_dcm = pydicom.dcmread(annotation_path)
+
+    original = normalize_to_uint8(original_dcm.pixel_array)
+    annotation = place_overlay(
+        original.shape, annotation_dcm.overlay_array(0x6000), annotation_dcm[0x6000,0x0050].value
+    )
+    overlay = cv2.add(original, annotation)
+
+    outputs = [
+        f'{overlaid_image}/{i}_original.png',
+        f'{overlaid_image}/{i}_annotation.png',
+        f'{overlaid_image}/{i}_overlay.png',
+        f'{overlaid_image_only}/{i}_overlay.png',
+    ]
+    cv2.imwrite(outputs[0], original)
+    cv2.imwrite(outputs[1], annotation)
+    cv2.imwrite(outputs[2], overlay)
+    cv2.imwrite(outputs[3], overlay)
+
+    return {'outputs': outputs}
 
-    # show_img.save(f'{args.dicom_to_png_path}/annotation_image/{path[0]}_{path[1]}_{path[2]}_{count}_{data_name}.png')
-    show_img.save(f'{args.dicom_to_png_path}/annotation_image/{path[0]}_{path[1]}_{path[2]}_{path[3]}_{data_name}.png')
-    count += 1
-    # show_img.show()
-    return count
-        
 def overlay_two_images(original_annotation_list, args):
-    count = 0
-
-    for i in tqdm(range(len(original_annotation_list))):
-    # for i in range(len(original_annotation_list)):
-        # print(f"\n----- original: {original_annotation_list[i][0]}, annotation: {original_annotation_list[i][-1]} -----")
-
-        try:
-            split_original = original_annotation_list[i][0].split("_")
-            split_annotation = original_annotation_list[i][-1].split("_")
-
-            original_path = f"./data/{split_original[0]}/{split_original[1]}/{split_original[2]}/{split_original[3]}/{split_original[4]}"
-            annotation_path = f"./data/{split_annotation[0]}/{split_annotation[1]}/{split_annotation[2]}/{split_annotation[3]}/{split_annotation[4]}"
-
-            original_dcm = pydicom.dcmread(original_path)
-            annotation_dcm = pydicom.dcmread(annotation_path)
-
-            original_arr = original_dcm.pixel_array
-            annotation_arr = annotation_dcm.overlay_array(0x6000)
-
-            # print(f"original image size: \t{original_arr.shape}")
-            # print(f"annotation image size: \t{annotation_arr.shape}")
-            # print(f"annotation overlay range: \t {annotation_dcm[0x6000,0x0050]}")
-
-            ## todo: filling width
-            # if original_arr.shape[0] < annotation_arr.shape[0]:
-            left_fill = annotation_dcm[0x6000,0x0050][1]-1
-            middle_fill = len(annotation_arr[0])
-            right_fill = len(original_arr[0])-(annotation_dcm[0x6000,0x0050][1]-1)-len(annotation_arr[0])
-
-            new_arr = np.array(
-                [[0]*(left_fill+middle_fill+right_fill) for _ in range(len(annotation_arr))]
-            )
-
-            for j in range(len(annotation_arr)):
-                left = np.array([0]*left_fill)
-                middle = annotation_arr[j]
-                right = np.array([0]*right_fill)
-
-                tmp = np.concatenate((left, middle), axis=0)
-                new_arr[j] = np.concatenate((tmp, right), axis=0)
-
-            ## todo: filling height
-            if original_arr.shape[0] > annotation_arr.shape[0]:
-                upper_fill = annotation_dcm[0x6000,0x0050][0]-1
-                middle_fill = len(annotation_arr)
-                lower_fill = len(original_arr)-(annotation_dcm[0x6000,0x0050][0]-1)-len(annotation_arr)
-                # print(f'lower fill: {len(original_arr)} - {annotation_dcm[0x6000,0x0050][0]-1} - {len(annotation_arr)} = {lower_fill}')
-
-                high = np.zeros((upper_fill, original_arr.shape[1]))
-                low = np.zeros((lower_fill, original_arr.shape[1]))
-
-                tmp = np.vstack([high, new_arr])
-                new_arr = np.vstack([tmp, low])
-
-            change_arr = np.asarray(new_arr, dtype = np.int32)
-
-            for j in range(len(change_arr)):
-                for k in range(len(change_arr[j])):
-                    if change_arr[j][k] == 1:
-                        change_arr[j][k] = 254
-
-            # print(original_arr.shape)
-            # print(f"annotation image size: \t{change_arr.shape}")
-
-            original_img = Image.fromarray(original_arr)
-            norm = (original_img - np.min(original_img)) / (np.max(original_img) - np.min(original_img))
-            norm_img = np.uint8(norm*255)
-            original = Image.fromarray(norm_img)
-            original.save(f'{args.overlaid_image}/{i}_original.png')
-            
-            annotation_img = Image.fromarray(change_arr)
-            norm = (annotation_img - np.min(annotation_img)) / (np.max(annotation_img) - np.min(annotation_img))
-            norm_img = np.uint8(norm*255)
-            annotation = Image.fromarray(norm_img)
-            annotation.save(f'{args.overlaid_image}/{i}_annotation.png')
-            # annotation.show()
-
-            ## todo: if final annotation and original image size is same
-            if original_arr.shape == change_arr.shape:
-                org = cv2.imread(f'{args.overlaid_image}/{i}_original.png', cv2.IMREAD_COLOR)
-                ann = cv2.imread(f'{args.overlaid_image}/{i}_annotation.png', cv2.IMREAD_COLOR)
-                overlay = cv2.add(org, ann)
-                cv2.imwrite(f'{args.overlaid_image_only}/{i}_overlay.png',overlay)
-                cv2.imwrite(f'{args.overlaid_image}/{i}_overlay.png',overlay)
-
-            ## todo: 
-            ## 1. when height is different
-            ## (2. when width is different)
-            else:
-                org = cv2.imread(f'{args.overlaid_image}/{i}_original.png', cv2.IMREAD_COLOR)
-                ann = cv2.imread(f'{args.overlaid_image}/{i}_annotation.png', cv2.IMREAD_COLOR)
-                cut = ann.shape[0] - org.shape[0]
-
-                """
-                ## upper and middle will not be used - only lower will be used
-
-                ## todo: 1-1 crop upper
-                upper_cropped = ann[cut:,:].copy()
-                upper_overlay = cv2.add(org, upper_cropped)
-                cv2.imwrite(f'./tmp/{i}_overlay_cut_upper.png',upper_overlay)
-
-                ## todo: 1-2 crop up & low
-                try:
-                    middle_cropped = ann[int((cut/2)):len(ann)-int((cut/2)),:].copy()
-                    middle_overlay = cv2.add(org, middle_cropped)
-                except:
-                    middle_cropped = ann[int((cut/2)):len(ann)-int((cut/2))-1,:].copy()
-                    middle_overlay = cv2.add(org, middle_cropped)
-                cv2.imwrite(f'./tmp/{i}_overlay_cut_up_low.png',middle_overlay)
-                """
-
-                ## todo: 1-3 crop lower 
-                lower_cropped = ann[:len(ann)-cut,:].copy()
-                lower_overlay = cv2.add(org, lower_cropped)
-                # cv2.imwrite(f'./tmp/{i}_overlay_cut_lower.png',lower_overlay)
-                cv2.imwrite(f'{args.overlaid_image_only}/{i}_overlay.png',lower_overlay)
-                cv2.imwrite(f'{args.overlaid_image}/{i}_overlay.png',lower_overlay)
-
-            count += 1
-        
-        except Exception as e:
-            error_message = f'Error on {original_annotation_list[i]} -> {e}'
-            print(error_message)
-            # printsave(error_message)
-            pass
-
-
-def printsave(*a):
-    file = open('error_log.txt','a')
-    print(*a,file=file)
- 
+    worker = partial(
+        overlay_study, overlaid_image=args.overlaid_image, overlaid_image_only=args.overlaid_image_only
+    )
+    params = {'overlaid_image': args.overlaid_image, 'overlaid_image_only': args.overlaid_image_only}
+    tasks = list(enumerate(original_annotation_list))
+
+    ## the study index is part of the output names, so the key also holds the study itself
+    return run_stage(
+        'overlay', worker, tasks, params, args,
+        get_inputs=lambda task: list(get_study_paths(task[1])),
+        get_key=lambda task: f'{task[0]}:{task[1][0]}:{task[1][-1]}',
+    )
+
 
 def dicom2png(dicom_lists, args):
     if not os.path.exists(f'{args.dicom_to_png_path}'):                  os.mkdir(f'{args.dicom_to_png_path}')
     if not os.path.exists(f'{args.dicom_to_png_path}/original_image'):   os.mkdir(f'{args.dicom_to_png_path}/original_image')
     if not os.path.exists(f'{args.dicom_to_png_path}/annotation_image'): os.mkdir(f'{args.dicom_to_png_path}/annotation_image')
-    count = 0
     
     print("---------- Starting Preprocessing ----------")
-    for dicom_list in tqdm(dicom_lists):
-        path = dicom_list.split('/')[2:6]
-        data_name = dicom_list.split('/')[-1]
-        dcm_info = pydicom.read_file(dicom_list, force=True)
-        
-        try: 
-            try:
-                count = get_pixel_array(dcm_info, path, data_name, count, args)
-            except:
-                count = get_overlay_array(dcm_info, path, data_name, count, args)
-        except Exception as e:
-            print(f'Error on {dicom_list} -> {e}')
+    worker = partial(convert_dicom, output_path=args.dicom_to_png_path)
+    params = {'dicom_to_png_path': args.dicom_to_png_path}
+    records = run_stage('dicom2png', worker, dicom_lists, params, args)
 
+    kinds = [record['info']['kind'] for record in records if record['status'] == 'done']
+    print(f"image: {kinds.count('image')}, overlay: {kinds.count('overlay')}, unusable: {kinds.count('unusable')}")
     print("---------- Preprocessing Done ----------\n")
 
+    return records
+
 def dicom2png_overlay(original_annotation_list, args):
     if not os.path.exists(f'{args.overlaid_image}'):      os.mkdir(f'{args.overlaid_image}')
     if not os.path.exists(f'{args.overlaid_image_only}'): os.mkdir(f'{args.overlaid_image_only}')
 
     print("---------- Starting Overlay Process ----------")
-    overlay_two_images(original_annotation_list, args)
+    records = overlay_two_images(original_annotation_list, args)
     print("---------- Overlay Process Done ----------\n")
 
+    return records
+
 def customize_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -250,108 +399,197 @@ def customize_seed(seed):
     random.seed(seed)
 
 
-## todo: currently padded images has the annotations. need to fix.
-def pad_original_image(args):
-    print("---------- Starting Padding Original Image Process ----------")
-    if not os.path.exists(f'{args.padded_image}'): 
-        os.mkdir(f'{args.padded_image}')
-    original_image_path = sorted(glob(f'{args.overlaid_image}/*_original.png'))
-
-    for overlaid_path in tqdm(original_image_path):
-        image_num = overlaid_path.split('/')[-1].split('_')[0]
-        overlaid_image_array = cv2.imread(overlaid_path)
-        fill = abs(overlaid_image_array.shape[0] - overlaid_image_array.shape[1])
-        
-        ## when height > width
-        if overlaid_image_array.shape[0] > overlaid_image_array.shape[1]:
-            padded_array = np.zeros((
-                overlaid_image_array.shape[0], overlaid_image_array.shape[0], 3
-            ))
-        
-            for i in range(overlaid_image_array.shape[0]):
-                left = np.zeros((int(fill/2),3))
-                middle = np.array(overlaid_image_array[i])
-                if fill % 2 == 0: right = np.zeros((int(fill/2),3))
-                else:             right = np.zeros((int(fill/2)+1,3))
-
-                tmp = np.concatenate((left, middle), axis=0)
-                padded_array[i] = np.concatenate((tmp, right), axis=0)
-
-        ## when height < width
-        elif overlaid_image_array.shape[0] < overlaid_image_array.shape[1]:            
-            padded_array = np.zeros((
-                overlaid_image_array.shape[1], overlaid_image_array.shape[1], 3
-            ))
-
-            high = np.zeros((int(fill/2),overlaid_image_array.shape[1],3))
-            if fill % 2 == 0: low = np.zeros((int(fill/2),overlaid_image_array.shape[1],3))
-            else:             low = np.zeros((int(fill/2)+1,overlaid_image_array.shape[1],3))
-
-            tmp = np.vstack([high, overlaid_image_array])
-            padded_array = np.vstack([tmp, low])
-        
-        ## when height == width
-        else: 
-            padded_array = np.zeros((
-                overlaid_image_array.shape[0], overlaid_image_array.shape[1], 3
-            ))
-            padded_array = overlaid_image_array[:]
-
-        norm = (padded_array - np.min(padded_array)) / (np.max(padded_array) - np.min(padded_array))
-        norm_img = np.uint8(norm*255)
-        padded_image = Image.fromarray(norm_img)
-        padded_image.save(f'{args.padded_image}/{image_num}_pad.png')
-    print("---------- Padding Original Image Process Done ----------")
-
-
-def pad_overlaid_image(args):
-    print("---------- Starting Padding Overlaid Image Process ----------")
-    if not os.path.exists(f'{args.overlaid_padded_image}'): 
-        os.mkdir(f'{args.overlaid_padded_image}')
-    overlaid_image_path = sorted(glob(f'{args.overlaid_image}/*_overlay.png'))
-
-    for overlaid_path in tqdm(overlaid_image_path):
-        image_num = overlaid_path.split('/')[-1].split('_')[0]
-        overlaid_image_array = cv2.imread(overlaid_path)
-        fill = abs(overlaid_image_array.shape[0] - overlaid_image_array.shape[1])
-        
-        ## when height > width
-        if overlaid_image_array.shape[0] > overlaid_image_array.shape[1]:
-            padded_array = np.zeros((
-                overlaid_image_array.shape[0], overlaid_image_array.shape[0], 3
-            ))
-        
-            for i in range(overlaid_image_array.shape[0]):
-                left = np.zeros((int(fill/2),3))
-                middle = np.array(overlaid_image_array[i])
-                if fill % 2 == 0: right = np.zeros((int(fill/2),3))
-                else:             right = np.zeros((int(fill/2)+1,3))
-
-                tmp = np.concatenate((left, middle), axis=0)
-                padded_array[i] = np.concatenate((tmp, right), axis=0)
-
-        ## when height < width
-        elif overlaid_image_array.shape[0] < overlaid_image_array.shape[1]:            
-            padded_array = np.zeros((
-                overlaid_image_array.shape[1], overlaid_image_array.shape[1], 3
-            ))
-
-            high = np.zeros((int(fill/2),overlaid_image_array.shape[1],3))
-            if fill % 2 == 0: low = np.zeros((int(fill/2),overlaid_image_array.shape[1],3))
-            else:             low = np.zeros((int(fill/2)+1,overlaid_image_array.shape[1],3))
-
-            tmp = np.vstack([high, overlaid_image_array])
-            padded_array = np.vstack([tmp, low])
-        
-        ## when height == width
-        else: 
-            padded_array = np.zeros((
-                overlaid_image_array.shape[0], overlaid_image_array.shape[1], 3
-            ))
-            padded_array = overlaid_image_array[:]
-
-        norm = (padded_array - np.min(padded_array)) / (np.max(padded_array) - np.min(padded_array))
-        norm_img = np.uint8(norm*255)
-        padded_image = Image.fromarray(norm_img)
-        padded_image.save(f'{args.overlaid_padded_image}/{image_num}_pad.png')
-    print("---------- Padding Original Image Process Done ----------")
+def letterbox(image, fill=0):
+    """
+    pad the shorter side with a constant border so that height == width
+    the image stays in the center, an odd difference puts the extra pixel on the right/bottom
+    returns the padded image and the (top, bottom, left, right) pad offsets
+    """
+    height, width = image.shape[:2]
+    diff = abs(height - width)
+    if height > width: top, bottom, left, right = 0, 0, diff//2, diff - diff//2
+    else:              top, bottom, left, right = diff//2, diff - diff//2, 0, 0
+
+    padded = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=fill)
+    return padded, (top, bottom, left, right)
+
+def pad_study(source_path, output_path, image_resize):
+    """
+    letterbox a single png, used as the worker of pad_images
+    pad offsets and the scale to image_resize are saved in a json sidecar next to the padded image
+    """
+    image_num = source_path.split('/')[-1].split('_')[0]
+    image = cv2.imread(source_path, cv2.IMREAD_GRAYSCALE)
+    padded, pads = letterbox(image)
+
+    metadata = get_pad_metadata(source_path, image.shape, pads, padded.shape[0], image_resize)
+    return {'outputs': save_padded_image(f'{output_path}/{image_num}_pad.png', padded, metadata)}
+
+def get_pad_metadata(source, shape, pads, size, image_resize, stored_size=None):
+    """
+    size is the letterboxed size at full resolution, the frame of the pads, stored_size is the size of the
+    saved image (smaller than size with --preprocess_resize), which is the frame the annotation is done in
+    """
+    top, bottom, left, right = pads
+    stored_size = stored_size or size
+    return {
+        'source': source,
+        'height': shape[0], 'width': shape[1],
+        'pad_top': top, 'pad_bottom': bottom, 'pad_left': left, 'pad_right': right,
+        'size': size, 'stored_size': stored_size,
+        'image_resize': image_resize, 'scale': image_resize / stored_size,
+    }
+
+def save_padded_image(save_path, image, metadata):
+    cv2.imwrite(save_path, image)
+    with open(get_metadata_path(save_path), 'w') as f:
+        json.dump(metadata, f)
+    return [save_path, get_metadata_path(save_path)]
+
+def get_metadata_path(image_path):
+    return f'{os.path.splitext(image_path)[0]}.json'
+
+def load_pad_metadata(image_path):
+    """
+    pad offsets and scale of a padded image, None if the image has no sidecar
+    """
+    metadata_path = get_metadata_path(image_path)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, 'r') as f:
+        return json.load(f)
+
+def pad_images(args):
+    """
+    pad the original images into args.padded_image and the overlaid images into args.overlaid_padded_image
+    """
+    print("---------- Starting Padding Image Process ----------")
+    stages = [
+        ('pad_original', '*_original.png', args.padded_image),
+        ('pad_overlaid', '*_overlay.png',  args.overlaid_padded_image),
+    ]
+    records = []
+    for stage, pattern, output_path in stages:
+        if not os.path.exists(f'{output_path}'): 
+            os.mkdir(f'{output_path}')
+        image_paths = sorted(glob(f'{args.overlaid_image}/{pattern}'))
+
+        worker = partial(pad_study, output_path=output_path, image_resize=args.image_resize)
+        params = {'output_path': output_path, 'image_resize': args.image_resize}
+        records += run_stage(stage, worker, image_paths, params, args)
+    print("---------- Padding Image Process Done ----------")
+
+    return records
+
+
+def decode_studies(tasks):
+    for i, original_annotation in tasks:
+        original_path, annotation_path = get_study_paths(original_annotation)
+        original_dcm = pydicom.dcmread(original_path)
+        annotation_dcm = read_dicom_header(annotation_path)
+        yield {
+            'index':         i,
+            'source':        original_path,
+            'original':      original_dcm.pixel_array,
+            'overlay_plane': annotation_dcm.overlay_array(0x6000),
+            'origin':        annotation_dcm[0x6000,0x0050].value,
+        }
+
+def normalize_studies(studies):
+    for study in studies:
+        study['original'] = normalize_to_uint8(study['original'])
+        yield study
+
+def overlay_studies(studies):
+    for study in studies:
+        study['annotation'] = place_overlay(study['original'].shape, study.pop('overlay_plane'), study['origin'])
+        study['overlay'] = cv2.add(study['original'], study['annotation'])
+        yield study
+
+def letterbox_studies(studies):
+    for study in studies:
+        study['shape'] = study['original'].shape
+        study['padded_original'], study['pads'] = letterbox(study['original'])
+        study['padded_overlay'], _ = letterbox(study['overlay'])
+        study['size'] = study['padded_original'].shape[0]
+        yield study
+
+def resize_studies(studies, preprocess_resize):
+    for study in studies:
+        ## only ever downsampled, a film smaller than preprocess_resize is saved at full resolution
+        if 0 < preprocess_resize < study['padded_original'].shape[0]:
+            for key in ['padded_original', 'padded_overlay']:
+                study[key] = cv2.resize(
+                    study[key], (preprocess_resize, preprocess_resize), interpolation=cv2.INTER_AREA
+                )
+        yield study
+
+def write_studies(studies, params):
+    for study in studies:
+        i = study['index']
+        metadata = get_pad_metadata(
+            study['source'], study['shape'], study['pads'], study['size'], params['image_resize'],
+            stored_size=study['padded_original'].shape[0],
+        )
+        outputs = save_padded_image(f"{params['padded_image']}/{i}_pad.png", study['padded_original'], metadata)
+        outputs += save_padded_image(f"{params['overlaid_padded_image']}/{i}_pad.png", study['padded_overlay'], metadata)
+
+        ## intermediates of the previous overlay_two_images, nothing in training reads them
+        if params['save_debug_images']:
+            outputs += [
+                f"{params['overlaid_image']}/{i}_original.png",
+                f"{params['overlaid_image']}/{i}_annotation.png",
+                f"{params['overlaid_image']}/{i}_overlay.png",
+                f"{params['overlaid_image_only']}/{i}_overlay.png",
+            ]
+            cv2.imwrite(outputs[-4], study['original'])
+            cv2.imwrite(outputs[-3], study['annotation'])
+            cv2.imwrite(outputs[-2], study['overlay'])
+            cv2.imwrite(outputs[-1], study['overlay'])
+
+        yield {'outputs': outputs}
+
+def stream_pipeline(tasks, params):
+    """
+    decode -> normalize -> overlay -> letterbox -> resize -> write, 
+    every intermediate frame stays in memory and only the padded images (+ sidecars) are written
+    """
+    studies = decode_studies(tasks)
+    studies = normalize_studies(studies)
+    studies = overlay_studies(studies)
+    studies = letterbox_studies(studies)
+    studies = resize_studies(studies, params['preprocess_resize'])
+    return write_studies(studies, params)
+
+def stream_study(task, params):
+    return next(stream_pipeline([task], params))
+
+def stream_preprocess(original_annotation_list, args):
+    """
+    replaces dicom2png_overlay + pad_images, from the dicoms straight to args.padded_image and args.overlaid_padded_image
+    """
+    print("---------- Starting Streaming Preprocess ----------")
+    params = {
+        'padded_image':          args.padded_image,
+        'overlaid_padded_image': args.overlaid_padded_image,
+        'overlaid_image':        args.overlaid_image,
+        'overlaid_image_only':   args.overlaid_image_only,
+        'image_resize':          args.image_resize,
+        'preprocess_resize':     args.preprocess_resize,
+        'save_debug_images':     args.save_debug_images,
+    }
+    directories = [args.padded_image, args.overlaid_padded_image]
+    if args.save_debug_images:
+        directories += [args.overlaid_image, args.overlaid_image_only]
+    for directory in directories:
+        if not os.path.exists(f'{directory}'):
+            os.mkdir(f'{directory}')
+
+    records = run_stage(
+        'stream', partial(stream_study, params=params), list(enumerate(original_annotation_list)), params, args,
+        get_inputs=lambda task: list(get_study_paths(task[1])),
+        get_key=lambda task: f'{task[0]}:{task[1][0]}:{task[1][-1]}',
+    )
+    print("---------- Streaming Preprocess Done ----------\n")
+
+    return records
@@ -0,0 +1,80 @@
+"""
+sharded, packed dataset for a fast cold start
+
+the rows of dataset.csv and test_dataset.csv are packed with their padded images (resized to image_resize),
+landmark coordinates and pad/scale sidecars into a few .npz shards of --shard_size images, next to an index.json.
+the shard directory is a single artifact that can be copied to a scratch disk, and dataset.ShardDataset streams it
+with one sequential read per shard instead of opening thousands of pngs
+"""
+
+import os
+import json
+import cv2
+import numpy as np
+import pandas as pd
+
+from functools import partial
+
+from preprocess import run_in_pool, write_error_manifest, load_pad_metadata
+from dataset import get_image_names, get_label_coordinates
+
+
+def write_shard(task, padded_image, shard_path, image_resize):
+    """
+    decode, resize and pack the images of one shard, used as the worker of export_shards
+    """
+    shard_file, image_names, coordinates = task
+    images = np.zeros((len(image_names), image_resize, image_resize), dtype=np.uint8)
+    metadata = []
+    for i, image_name in enumerate(image_names):
+        image_path = f'{padded_image}/{image_name}'
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        ## same interpolation as A.Resize
+        images[i] = cv2.resize(image, (image_resize, image_resize), interpolation=cv2.INTER_LINEAR)
+        metadata.append(json.dumps(load_pad_metadata(image_path)))
+
+    np.savez(
+        f'{shard_path}/{shard_file}',
+        images=images, coordinates=np.array(coordinates, dtype=np.int32),
+        names=np.array(image_names), metadata=np.array(metadata),
+    )
+    return {'outputs': [f'{shard_path}/{shard_file}']}
+
+
+def export_shards(args):
+    print("---------- Starting Exporting Shards ----------")
+    if not os.path.exists(f'{args.shard_path}'):
+        os.mkdir(f'{args.shard_path}')
+    ## the index of an earlier export no longer matches once its shards are overwritten
+    if os.path.exists(f'{args.shard_path}/index.json'):
+        os.remove(f'{args.shard_path}/index.json')
+
+    tasks, shards = [], []
+    for group, csv_path in (('train_val', args.dataset_csv_path), ('test', args.test_dataset_csv_path)):
+        df = pd.read_csv(csv_path)
+        image_names = get_image_names(df['image'])
+        coordinates = get_label_coordinates(df, args.output_channel)
+        for start in range(0, len(df), args.shard_size):
+            stop = min(start + args.shard_size, len(df))
+            shard_file = f'{group}_{start // args.shard_size:05d}.npz'
+            tasks.append((shard_file, image_names[start:stop], coordinates[start:stop].tolist()))
+            shards.append({'file': shard_file, 'group': group, 'start': start, 'count': stop - start})
+
+    worker = partial(write_shard, padded_image=args.padded_image, shard_path=args.shard_path, image_resize=args.image_resize)
+    records = run_in_pool(worker, tasks, args, desc='shards')
+    failed = write_error_manifest(records, 'shards', args)
+    ## an index with missing or stale shards would crash or silently mislead the training later
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(tasks)} shards could not be written, see {args.error_manifest} and export them again"
+        )
+
+    index = {
+        'image_resize':   args.image_resize,
+        'output_channel': args.output_channel,
+        'shards':         shards,
+    }
+    with open(f'{args.shard_path}/index.json', 'w') as f:
+        json.dump(index, f, indent=4)
+    print(f"{sum(shard['count'] for shard in shards)} images packed into {len(shards)} shards in {args.shard_path}")
+    print("---------- Exporting Shards Done ----------\n")
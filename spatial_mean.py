@@ -50,116 +50,51 @@ class SpatialMean_CHAN(nn.Module):
     INPUT: Tensor [ Batch x Channels x H x W x D ]
     OUTPUT: Tensor [ BATCH x Channels x 3]
 
+    The mean is separable, so every axis is reduced to its marginal and weighted with
+    a 1-D coordinate vector instead of a full H x W x D coordinate tensor. The vectors
+    are cached per (size, device, dtype), so one module serves every input shape.
     """
 
-    def __init__(self, input_shape, eps=1e-6, pytorch_order=True, return_power=False, **kwargs):
+    def __init__(self, input_shape=None, eps=1e-6, pytorch_order=True, return_power=False, **kwargs):
 
         super(SpatialMean_CHAN, self).__init__(**kwargs)
 
+        ## input_shape is only kept for the old call sites, the shape is taken from the input
         self.eps = eps
         self.size_in = input_shape
-
-        self.coord_idx_list = []
-        self.input_shape_nb_nc = input_shape[1:]
-        self.n_chan = input_shape[0]
-
-        for idx, in_shape in enumerate(self.input_shape_nb_nc):
-            coord_idx_tensor = torch.arange(0, in_shape)
-            coord_idx_tensor = torch.reshape(
-                coord_idx_tensor,
-                [in_shape] + [1]*(len(self.input_shape_nb_nc)-1)
-            )
-
-            # coord_idx_tensor = torch.repeat_interleave(
-            #  coord_idx_tensor,
-            #  torch.tensor([1] + self.input_shape_nb_nc[:idx] + self.input_shape_nb_nc[idx+1:])
-            # )
-            coord_idx_tensor = coord_idx_tensor.repeat(
-                *([1] + self.input_shape_nb_nc[:idx] + self.input_shape_nb_nc[idx+1:]))
-
-            coord_idx_tensor = coord_idx_tensor.permute(
-                *(list(range(1, idx+1)) + [0] + list(range(idx+1, len(self.input_shape_nb_nc))))
-            )
-
-            self.coord_idx_list.append(
-                torch.reshape(coord_idx_tensor, [-1])
-            )
-            # self.coord_idx_list.append(
-            #  torch.reshape(torch.cast(coord_idx_tensor, tf.float32),[-1])
-            # )
-
-        # print("WARNING [spatial_mean]: pytorch reverses its axes because why not.",
-        #       "Thus, pytorch(z,y,x) is the order output unless specified via:\n",
-        #       "pytorch_order=False\n",
-        #       "This order is NOT reversed (i.e. left ambiguous) in their affine_grid",
-        #       sep=" ")
         self.pytorch_order = pytorch_order
-        if pytorch_order:
-            self.coord_idx_list.reverse()
-
-        self.coord_idxs = torch.stack(self.coord_idx_list)
-        self.coord_idxs = torch.unsqueeze(self.coord_idxs, 0)
-        self.coord_idxs = torch.unsqueeze(self.coord_idxs, 0)
-        # TODO Here we can (re)map over the channel dims instead of tilling
-        # self.coord_idxs = self.coord_idxs.repeat(self.n_chan,1,1)
-
         self.return_power = return_power
+        self.coord_cache = {}
 
-    def _apply_coords(self, x, verbose=False):
-        #!ALERT This is what the warning is about
-
-        if verbose:
-            print(x.shape)
-            print(self.coord_idxs.shape)
-
-        # x = torch.unsqueeze( x, 1 ).repeat(1,3,1)
-        x = torch.unsqueeze(x, 2)
-
-        if verbose:
-            print(x.shape)
-        
-        ## RuntimeError: Expected all tensors to be on the same device, 
-        ## but found at least two devices, cuda:0 and cpu!
-        self.coord_idxs = self.coord_idxs.to(device='cuda')
-
-        numerator = torch.sum(x*self.coord_idxs, dim=[3])
-
-        # here, we do not want the gradient to see a normalization.
-        denominator = torch.sum(torch.abs(x.detach()) + self.eps, dim=[3])
-
-        if verbose:
-            print(numerator.shape)
-            print(denominator.shape)
-        return numerator / denominator
+    def get_coords(self, size, device, dtype):
+        key = (size, device, dtype)
+        if key not in self.coord_cache:
+            self.coord_cache[key] = torch.arange(size, device=device, dtype=dtype)
+        return self.coord_cache[key]
 
     def forward(self, x):
-        # batch
-        # x = keras.backend.batch_flatten(x)
-        x = torch.reshape(
-            x, [-1, self.n_chan, np.prod(self.input_shape_nb_nc)])
+        ## eps and the coordinate sums do not fit in half precision
+        if x.dtype in (torch.float16, torch.bfloat16):
+            x = x.float()
         x = torch.abs(x)
-        # print("power by chan",power_by_chan)
+        spatial_dims = list(range(2, x.dim()))
+
+        outputs = []
+        for dim in spatial_dims:
+            ## marginal of the axis, B x C x size
+            marginal = x.sum(dim=[other for other in spatial_dims if other != dim]) if len(spatial_dims) > 1 else x
+            coords = self.get_coords(x.shape[dim], x.device, x.dtype)
+            outputs.append(torch.matmul(marginal, coords))
+        ## pytorch reverses its axes, the output is (x, y, z) unless pytorch_order=False
+        if self.pytorch_order:
+            outputs.reverse()
+        numerator = torch.stack(outputs, dim=2)
 
-        # haha these are some axes.
-        # but really, they're the axes we sum over
-        # sum_axes = list(range(len(self.input_shape_nb_nc)))
-        # sum_axes = [1] #list(range(len(self.input_shape_nb_nc)))
-
-        # outputs = torch.vmap( self._apply_coords )(x)
-        # outputs = []
-        outputs = self._apply_coords(x)
-        # for idx in range( x.size(0) ):
-        #  outputs.append(self._apply_coords(x[idx]))
-        # outputs = torch.stack(outputs)
+        # here, we do not want the gradient to see a normalization.
+        power_by_chan = x.sum(dim=spatial_dims)
+        denominator = power_by_chan.detach() + self.eps * np.prod(x.shape[2:])
+        outputs = numerator / denominator.unsqueeze(2)
 
         if self.return_power:
-            power_by_chan = x.sum(dim=2, keepdim=True)
-            return outputs, power_by_chan
-        return outputs  # K.mean(K.batch_flatten(K.square(x[0] - x[1])), -1)
-
-    def to(self, *args, **kwargs):
-        self = super().to(*args, **kwargs)
-        self.coord_idxs = self.coord_idxs.to(*args, **kwargs)
-        for idx in range(len(self.coord_idx_list)):
-            self.coord_idx_list[idx].to(*args, **kwargs)
-        return self
\ No newline at end of file
+            return outputs, power_by_chan.unsqueeze(2)
+        return outputs
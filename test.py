@@ -15,7 +15,7 @@ from tqdm import tqdm
 
 from argument import arg_as_list
 from dataset import load_data
-from utility import extract_highest_probability_pixel, calculate_mse_predicted_to_annotation, calculate_angle
+from utility import get_autocast, decode_landmarks, stack_label_list, calculate_angles
 from visualization import angle_visualization, angle_graph
 
 
@@ -27,7 +27,8 @@ def get_pretrained_model(args, DEVICE):
         encoder_weights = 'imagenet', 
         encoder_depth   = args.encoder_depth,
         classes         = args.output_channel, 
-        activation      = 'sigmoid',
+        ## the sigmoid is applied in float32 outside of autocast, where probabilities are needed
+        activation      = None,
         decoder_channels= args.decoder_channel,
     )
     return model.to(DEVICE)
@@ -54,27 +55,33 @@ def main(args):
     LDFA_list, MPTA_list, mHKA_list = [], [], []
     predict_list = []
     angles = []
-    for idx, (image, _, data_path, label_list) in enumerate(tqdm(val_loader)):
-        # print(f"===== validation {idx} =====")
+    start = 0
+    for image, _, data_path, label_list in tqdm(val_loader):
         image = image.to(device=DEVICE)
 
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(args, DEVICE):
             preds = model(image)
-        index_list = extract_highest_probability_pixel(args, preds)
-        
-        LDFA   , MPTA   , mHKA    = calculate_angle(args, index_list, "preds")
-        LDFA_GT, MPTA_GT, mHKA_GT = calculate_angle(args, label_list, "label")
-        # print(f"LDFA   , MPTA   , mHKA   : {LDFA:.2f}, {MPTA:.2f}, {mHKA:.2f}")
-        # print(f"LDFA_GT, MPTA_GT, mHKA_GT: {LDFA_GT:.2f}, {MPTA_GT:.2f}, {mHKA_GT:.2f}")
-        # print(f"Difference: {LDFA-LDFA_GT:.2f}, {MPTA-MPTA_GT:.2f}, {mHKA-mHKA_GT:.2f}")
-        
-        total_LDFA += abs(LDFA-LDFA_GT)
-        total_MPTA += abs(MPTA-MPTA_GT)
-        total_mHKA += abs(mHKA-mHKA_GT)
-
-        angles.append([LDFA, MPTA, mHKA, LDFA_GT, MPTA_GT, mHKA_GT])
-        angle_visualization(args, experiment, data_path, idx, 300, index_list, label_list, 0, angles[idx], "without label", 'val_big_font')
-        angle_visualization(args, experiment, data_path, idx, 300, index_list, label_list, 0, angles[idx], "with label", 'val_big_font')
+        preds = preds.float()
+        predicted = decode_landmarks(preds, args.landmark_decoder, args.subpixel, args.soft_argmax_beta)
+        annotated = stack_label_list(args, label_list).to(DEVICE)
+        batch_angles = torch.cat([calculate_angles(args, predicted), calculate_angles(args, annotated)], dim=-1)
+        predicted, batch_angles = predicted.cpu().numpy(), batch_angles.cpu().numpy().tolist()
+
+        for i in range(len(image)):
+            idx = start + i
+            LDFA, MPTA, mHKA, LDFA_GT, MPTA_GT, mHKA_GT = batch_angles[i]
+            # print(f"LDFA   , MPTA   , mHKA   : {LDFA:.2f}, {MPTA:.2f}, {mHKA:.2f}")
+            # print(f"LDFA_GT, MPTA_GT, mHKA_GT: {LDFA_GT:.2f}, {MPTA_GT:.2f}, {mHKA_GT:.2f}")
+            # print(f"Difference: {LDFA-LDFA_GT:.2f}, {MPTA-MPTA_GT:.2f}, {mHKA-mHKA_GT:.2f}")
+
+            total_LDFA += abs(LDFA-LDFA_GT)
+            total_MPTA += abs(MPTA-MPTA_GT)
+            total_mHKA += abs(mHKA-mHKA_GT)
+
+            angles.append(batch_angles[i])
+            angle_visualization(args, experiment, [data_path[i]], idx, 300, predicted[i], label_list, 0, angles[idx], "without label", 'val_big_font')
+            angle_visualization(args, experiment, [data_path[i]], idx, 300, predicted[i], label_list, 0, angles[idx], "with label", 'val_big_font')
+        start += len(image)
     angle_graph(angles)
 
     # for idx, (image, _, data_path, label_list) in enumerate(tqdm(test_loader)):
@@ -208,9 +215,16 @@ if __name__ == '__main__':
     parser.add_argument('--progressive_erosion', action='store_true', help='whether to use progressive erosion')
     parser.add_argument('--progressive_weight', action='store_true', help='whether to use progressive weight')
     parser.add_argument('--pretrained', action='store_true', help='whether to pretrained model')
+    parser.add_argument('--amp', action='store_true', help='whether to use automatic mixed precision, float16 on cuda and bfloat16 on cpu')
     parser.add_argument('--wandb', action='store_true', help='whether to use wandb or not')
     parser.add_argument('--wandb_sweep', action='store_true', help='whether to use wandb or not')
     parser.add_argument('--no_image_save', action='store_true', help='whether to save image or not')
+    parser.add_argument('--coordinate_targets', action='store_true', help='whether to load only the landmark coordinates and synthesize the targets on the device')
+    parser.add_argument('--gpu_augmentation', action='store_true', help='whether to apply the random augmentation per batch on the training device instead of in the loader workers')
+    parser.add_argument('--image_store', action='store_true', help='whether to read the images from the packed image store')
+    parser.add_argument('--use_shards', action='store_true', help='whether to stream the dataset from the exported shards')
+    parser.add_argument('--loader_autotune', action='store_true', help='whether to benchmark a few dataloader configs and reuse the fastest one on this machine')
+    parser.add_argument('--transform_cache', action='store_true', help='whether to read the resized and normalized images from the transform cache')
 
     ## get dataset
     parser.add_argument('--excel_path', type=str, default="./xlsx/dataset.xlsx", help='path to dataset excel file')
@@ -222,6 +236,10 @@ if __name__ == '__main__':
     parser.add_argument('--overlaid_image_only', type=str, default="./data/overlay_only", help='path to save overlaid data')
     parser.add_argument('--overlaid_padded_image', type=str, default="./data/overlay_padded_image", help='path to save padded data')
     parser.add_argument('--padded_image', type=str, default="./data/padded_image", help='path to save padded data')
+    parser.add_argument('--image_store_path', type=str, default="./data/image_store", help='path to save the packed image store')
+    parser.add_argument('--shard_path', type=str, default="./data/shards", help='path to save the dataset shards')
+    parser.add_argument('--loader_config_path', type=str, default="./data/loader_config.json", help='path to save the tuned dataloader config of every machine')
+    parser.add_argument('--transform_cache_path', type=str, default="./data/transform_cache", help='path to save the resized and normalized images')
 
     ## hyperparameters - data
     parser.add_argument('--dataset_path', type=str, default="./data/dataset", help='dataset path')
@@ -231,12 +249,25 @@ if __name__ == '__main__':
     parser.add_argument('--annotation_text_name', type=str, default="annotation_label8.txt", help='annotation text file name')
     parser.add_argument('--test_annotation_text_name', type=str, default="annotation_label6_test.txt", help='annotation text file name')
     parser.add_argument('--dataset_split', type=int, default=9, help='dataset split ratio')
+    parser.add_argument('--num_folds', type=int, default=0, help='number of cross validation folds, 0 to use dataset_split')
+    parser.add_argument('--fold', type=int, default=0, help='cross validation fold used for validation')
+    parser.add_argument('--fold_seed', type=int, default=0, help='seed of the cross validation folds')
     parser.add_argument('--dilate', type=int, default=2, help='dilate iteration')
+    parser.add_argument('--target_type', type=str, default="diamond", choices=["diamond", "gaussian"], help='pattern of the target around every landmark')
     parser.add_argument('--dilation_decrease', type=int, default=5, help='dilation decrease in progressive erosion')
     parser.add_argument('--dilation_epoch', type=int, default=50, help='dilation per epoch')
     parser.add_argument('--image_path', type=str, default="./overlay_only", help='path to save overlaid data')
     parser.add_argument('--image_resize', type=int, default=512, help='image resize value')
     parser.add_argument('--batch_size', type=int, default=24, help='batch size')
+    parser.add_argument('--val_batch_size', type=int, default=8, help='batch size of validation and test')
+    parser.add_argument('--landmark_decoder', type=str, default='argmax', choices=['argmax', 'soft_argmax'], help='how the landmark coordinates are decoded from the heatmaps')
+    parser.add_argument('--subpixel', action='store_true', help='whether to refine the decoded landmarks to sub-pixel precision')
+    parser.add_argument('--soft_argmax_beta', type=float, default=1.0, help='inverse temperature of the soft-argmax of the angle loss and the soft_argmax decoder')
+    parser.add_argument('--loader_workers', type=int, default=-1, help='number of dataloader workers, -1 to choose them from the available cpus')
+    parser.add_argument('--shared_cache_mb', type=int, default=0, help='memory budget in MB of the decoded images shared by the dataloader workers, 0 to disable')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='number of batches loaded in advance by each dataloader worker')
+    parser.add_argument('--shuffle_buffer', type=int, default=64, help='number of items shuffled together when streaming the shards')
+    parser.add_argument('--loader_autotune_batches', type=int, default=10, help='number of batches timed per dataloader config by --loader_autotune')
     parser.add_argument('--delete_method', type=str, default="", help='how to delete unnecessary data in the xray images ["", "letter", "box"]')
     
     ## hyperparameters - model
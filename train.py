@@ -4,6 +4,8 @@ reference:
         https://github.com/aladdinpersson/Machine-Learning-Collection
 """
 
+import json
+import math
 import torch
 import torch.nn as nn
 import numpy as np
@@ -13,77 +15,205 @@ from tqdm import tqdm
 
 from spatial_mean import SpatialMean_CHAN
 from log import log_results, log_results_no_label
-from utility import create_directories, calculate_number_of_dilated_pixel, extract_highest_probability_pixel, calculate_mse_predicted_to_annotation, calculate_angle, compare_labels
+from utility import get_autocast, create_directories, calculate_number_of_dilated_pixel, compare_labels, decode_landmarks, stack_label_list, calculate_landmark_rmse, calculate_angles
 from visualization import save_predictions_as_images, box_plot, angle_visualization
-from dataset import load_data
+from dataset import to_target_masks
+from augmentation import BatchAugmentation
+
+
+def compute_losses(args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, spatial_mean, data, targets, label_list, dilate, batch_augmentation=None):
+    """
+    forward pass and losses of one training batch, shared by train_function and the batch size probe
+    """
+    data    = data.to(device=DEVICE)
+    targets = targets.to(device=DEVICE)
+    if batch_augmentation is not None:
+        data, targets = batch_augmentation(data, targets, coordinates=args.coordinate_targets)
+    targets = to_target_masks(targets, args, DEVICE, dilate)
+
+    with get_autocast(args, DEVICE):
+        logits = model(data)
+    ## the losses, the spatial mean and the soft-argmax run in float32 outside of autocast,
+    ## the pixel and geometry losses of the pretrained model see the probabilities of its former sigmoid head
+    logits = logits.float()
+    predictions = torch.sigmoid(logits) if args.pretrained else logits
+
+    # predictions =  torch.sigmoid(model(data))
+    # if args.no_sigmoid:
+    #     predictions_for_prob_pixel = model(data)
+    # else:
+    #     predictions_for_prob_pixel = torch.sigmoid(model(data))
+    
+    # calculate log loss with pixel value
+    loss_pixel = loss_fn_pixel(predictions, targets)
+
+    # calculate mse loss with spatial mean value, only reported and skipped unless it is asked for with --geom_loss
+    if args.geom_loss:
+        with torch.no_grad():
+            predict_spatial_mean = spatial_mean(predictions)
+            targets_spatial_mean = spatial_mean(targets)
+            loss_geometry        = loss_fn_geometry(predict_spatial_mean, targets_spatial_mean)
+    else:
+        loss_geometry = torch.zeros((), device=DEVICE)
+
+    # # calculate the difference between GT angle and predicted angle
+    # angle_pred, angle_gt = [], []
+    # for i in range(len(predictions_for_prob_pixel)):
+    #     index_list = extract_highest_probability_pixel(args, predictions_for_prob_pixel[i].unsqueeze(0))
+    #     angle_pred.append([calculate_angle(args, index_list, "preds")])
+    #     angle_gt.append([calculate_angle(args, label_list, "label")])
+    # loss_angle = loss_fn_angle(torch.Tensor(angle_pred), torch.Tensor(angle_gt))
+
+    # calculate the difference between GT angle and the angle of the soft-argmax landmarks,
+    # without --angle_loss it is only reported, from the cheaper argmax landmarks and without a gradient
+    annotated = stack_label_list(args, label_list).to(DEVICE)
+    if args.angle_loss:
+        loss_angle = loss_fn_angle(logits, annotated)
+    else:
+        with torch.no_grad():
+            angle_pred = calculate_angles(args, decode_landmarks(logits)).float()
+            angle_gt   = calculate_angles(args, annotated).float()
+            loss_angle = nn.functional.mse_loss(angle_pred, angle_gt)
+
+    loss = None
+    if args.pixel_loss:
+        if args.angle_loss: 
+            loss = args.angle_loss_weight*loss_pixel + loss_angle 
+        else:
+            loss = loss_pixel
+    # if args.geom_loss:  
+    #     loss = args.geom_loss_weight*loss_pixel + loss_geometry 
+
+    return loss, loss_pixel, loss_geometry, loss_angle
 
 
-def train_function(args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, optimizer, loader):
+def train_function(args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, optimizer, loader, spatial_mean, scaler, batch_augmentation=None):
     loop = tqdm(loader)
-    total_loss, total_pixel_loss, total_geom_loss, total_angle_loss = 0, 0, 0, 0
-    loss = None
+    ## the totals stay on the device, the host only reads them once per epoch
+    total_loss, total_pixel_loss, total_geom_loss, total_angle_loss = [torch.zeros((), device=DEVICE) for _ in range(4)]
     model.train()
 
-    for data, targets, _, label_list in loop:
-        data    = data.to(device=DEVICE)
-        targets = targets.float().to(device=DEVICE)
-
-        predictions =  model(data)
+    ## gradients of accumulation_steps batches are summed before every optimizer step. the batches are
+    ## counted as they come, len(loader) is not exact for the shards streamed by several workers
+    accumulation_steps = get_accumulation_steps(args)
+    accumulated = 0
+    optimizer.zero_grad()
 
-        # predictions =  torch.sigmoid(model(data))
-        # if args.no_sigmoid:
-        #     predictions_for_prob_pixel = model(data)
-        # else:
-        #     predictions_for_prob_pixel = torch.sigmoid(model(data))
-        
-        # calculate log loss with pixel value
-        loss_pixel = loss_fn_pixel(predictions, targets)
-
-        # calculate mse loss with spatial mean value
-        predict_spatial_mean_function = SpatialMean_CHAN(list(predictions.shape[1:]))
-        predict_spatial_mean          = predict_spatial_mean_function(predictions)
-        targets_spatial_mean_function = SpatialMean_CHAN(list(targets.shape[1:]))
-        targets_spatial_mean          = targets_spatial_mean_function(targets)
-        loss_geometry                 = loss_fn_geometry(predict_spatial_mean, targets_spatial_mean)
-
-        # # calculate the difference between GT angle and predicted angle
-        # angle_pred, angle_gt = [], []
-        # for i in range(len(predictions_for_prob_pixel)):
-        #     index_list = extract_highest_probability_pixel(args, predictions_for_prob_pixel[i].unsqueeze(0))
-        #     angle_pred.append([calculate_angle(args, index_list, "preds")])
-        #     angle_gt.append([calculate_angle(args, label_list, "label")])
-        # loss_angle = loss_fn_angle(torch.Tensor(angle_pred), torch.Tensor(angle_gt))
-
-        # calculate the difference between GT angle and predicted angle
-        angle_pred, angle_gt = [], []
-        for i in range(len(predictions)):
-            index_list = extract_highest_probability_pixel(args, predictions[i].unsqueeze(0))
-            angle_pred.append([calculate_angle(args, index_list, "preds")])
-            angle_gt.append([calculate_angle(args, label_list, "label")])
-        loss_angle = loss_fn_angle(torch.Tensor(angle_pred), torch.Tensor(angle_gt))
-
-        if args.pixel_loss:
-            if args.angle_loss: 
-                loss = args.angle_loss_weight*loss_pixel + loss_angle 
-            else:
-                loss = loss_pixel
-        # if args.geom_loss:  
-        #     loss = args.geom_loss_weight*loss_pixel + loss_geometry 
+    for step, (data, targets, _, label_list) in enumerate(loop):
+        loss, loss_pixel, loss_geometry, loss_angle = compute_losses(
+            args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, spatial_mean,
+            data, targets, label_list, loader.dataset.dilate, batch_augmentation,
+        )
 
         # backward
+        if accumulation_steps == 1: scaler.scale(loss).backward()
+        else:                       scaler.scale(loss / accumulation_steps).backward()
+        accumulated += 1
+        if accumulated == accumulation_steps:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            accumulated = 0
+
+        total_loss       += loss.detach()
+        total_pixel_loss += loss_pixel.detach()
+        total_geom_loss  += loss_geometry.detach()
+        total_angle_loss += loss_angle.detach()
+
+    ## the last group of the epoch is shorter, its gradients are rescaled to the mean over its batches
+    if accumulated:
+        scaler.unscale_(optimizer)
+        for group in optimizer.param_groups:
+            for parameter in group['params']:
+                if parameter.grad is not None:
+                    parameter.grad.mul_(accumulation_steps / accumulated)
+        scaler.step(optimizer)
+        scaler.update()
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
 
-        # update tqdm loop
-        loop.set_postfix(loss=loss.item())
+    ## losses of the last batch like before, read with one host sync
+    loss, loss_pixel, loss_geometry, loss_angle = torch.stack([loss, loss_pixel, loss_geometry, loss_angle]).detach().tolist()
+    return loss, loss_pixel, loss_geometry, loss_angle
+
+
+def get_accumulation_steps(args):
+    if not args.effective_batch_size:
+        return 1
+    return max(math.ceil(args.effective_batch_size / args.batch_size), 1)
+
+
+def make_probe_batch(args, batch_size):
+    """
+    random batch in the layout of the train loader
+    """
+    data = torch.randn(batch_size, 3, args.image_resize, args.image_resize)
+    coordinates = torch.randint(0, args.image_resize, (batch_size, args.output_channel, 2))
+    if args.coordinate_targets: targets = coordinates
+    else:                       targets = torch.zeros(batch_size, args.output_channel, args.image_resize, args.image_resize)
+    label_list = list(coordinates.reshape(batch_size, -1).T)
+    return data, targets, label_list
+
+
+def fits_batch_size(args, model, DEVICE, batch_size, losses, optimizer, scaler):
+    def probe_step():
+        data, targets, label_list = make_probe_batch(args, batch_size)
+        loss, loss_pixel, _, _ = compute_losses(args, DEVICE, model, *losses, data, targets, label_list, args.dilate, batch_augmentation)
+        scaler.scale(loss if loss is not None else loss_pixel).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        torch.cuda.synchronize()
+
+    batch_augmentation = BatchAugmentation(args) if args.augmentation and args.gpu_augmentation else None
+    ## the tensors of the failed step are only released once the exception is handled
+    fits = True
+    try:
+        probe_step()
+    except torch.cuda.OutOfMemoryError:
+        fits = False
+    optimizer.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return fits
+
+
+def find_batch_size(args, model, DEVICE, loss_fn_pixel, loss_fn_geometry, loss_fn_angle):
+    """
+    binary search of the largest per-step batch that trains on the device with the losses of the training step,
+    then the per-step batch that reaches the effective batch size with the fewest accumulation steps
+    """
+    print("---------- Starting Batch Size Probe ----------")
+    effective_batch_size = args.effective_batch_size or args.batch_size
+    if DEVICE != 'cuda':
+        print(f"no device memory to probe on {DEVICE}, batch size stays {args.batch_size}")
+        return min(args.batch_size, effective_batch_size)
+
+    ## the probe steps update the weights, they are put back afterwards
+    state_dict = {key: value.detach().cpu().clone() for key, value in model.state_dict().items()}
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
+    ## with progressive_weight the pixel loss is only made in train(), its memory does not depend on the weight
+    losses = (loss_fn_pixel or nn.BCEWithLogitsLoss(), loss_fn_geometry, loss_fn_angle, SpatialMean_CHAN())
+    model.train()
 
-        total_loss       += loss.item()
-        total_pixel_loss += loss_pixel.item() 
-        total_geom_loss  += loss_geometry.item()
-        total_angle_loss += loss_angle.item()
+    low, high = 0, min(args.max_batch_size_probe, effective_batch_size)
+    while low < high:
+        middle = (low + high + 1) // 2
+        fits = fits_batch_size(args, model, DEVICE, middle, losses, optimizer, scaler)
+        print(f"batch size {middle}: {'fits' if fits else 'out of memory'}")
+        if fits: low = middle
+        else:    high = middle - 1
 
-    return loss.item(), loss_pixel.item(), loss_geometry.item(), loss_angle.item()
+    model.load_state_dict(state_dict)
+    del optimizer, scaler
+    torch.cuda.empty_cache()
+    if low == 0:
+        raise RuntimeError(f"a batch of 1 at image_resize {args.image_resize} does not fit on the device")
+
+    ## e.g. 96 with 40 fitting takes 3 steps, of 32 instead of 40 which would make 120
+    accumulation_steps = math.ceil(effective_batch_size / low)
+    batch_size = math.ceil(effective_batch_size / accumulation_steps)
+    print(f"largest batch size: {low}, batch size of {accumulation_steps} accumulation steps: {batch_size}")
+    print("---------- Batch Size Probe Done ----------\n")
+    return batch_size
 
 
 def validate_function(loader, model, args, epoch, device):
@@ -94,44 +224,48 @@ def validate_function(loader, model, args, epoch, device):
     num_labels, num_labels_correct = 0, 0
     predict_as_label, prediction_correct  = 0, 0
     dice_score = 0
-    highest_probability_pixels_list = []
-    highest_probability_mse_total = 0
-    total_diff_LDFA, total_diff_MPTA, total_diff_mHKA = 0, 0, 0
-    mse_list = [[0]*len(loader) for _ in range(args.output_channel)]
+
+    ## per case results are scattered into preallocated arrays, one host copy per batch
+    num_cases = len(loader.dataset)
+    highest_probability_pixels = np.zeros((num_cases, args.output_channel, 2), dtype=np.float32)
+    rmse_total = np.zeros(num_cases)
+    rmse_landmarks = np.zeros((args.output_channel, num_cases))
+    angles_total = np.zeros((num_cases, 6))
 
     with torch.no_grad():
-        label_list_total, angles_total = [], []
-        for idx, (image, label, data_path, label_list) in enumerate(tqdm(loader)):
+        label_list_total = []
+        start = 0
+        for image, label, data_path, label_list in tqdm(loader):
             image = image.to(device)
-            label = label.to(device)
+            label = to_target_masks(label, args, device, loader.dataset.dilate)
             label_list_total.append(label.detach().cpu().numpy())
+            cases = slice(start, start + len(image))
             
-            if args.pretrained: preds = model(image)
-            else:               preds = torch.sigmoid(model(image))
-
-            ## extract the pixel with highest probability value
-            index_list = extract_highest_probability_pixel(args, preds)
-            highest_probability_mse, mse_list = calculate_mse_predicted_to_annotation(
-                args, index_list, label_list, idx, mse_list
-            )
-            
-            highest_probability_pixels_list.append(index_list)
-            highest_probability_mse_total += highest_probability_mse
+            with get_autocast(args, device):
+                preds = model(image)
+            logits = preds.float()
+            preds = torch.sigmoid(logits)
+
+            ## extract the landmarks from the logits, the probabilities are only used for the binary maps
+            predicted = decode_landmarks(logits, args.landmark_decoder, args.subpixel, args.soft_argmax_beta)
+            annotated = stack_label_list(args, label_list).to(device)
+            rmse, rmse_landmark = calculate_landmark_rmse(predicted, annotated)
 
             ## calculate angles for evaluation
-            LDFA   , MPTA   , mHKA    = calculate_angle(args, index_list, "preds")
-            LDFA_GT, MPTA_GT, mHKA_GT = calculate_angle(args, label_list, "label")
-            total_diff_LDFA += abs(LDFA_GT-LDFA)
-            total_diff_MPTA += abs(MPTA_GT-MPTA)
-            total_diff_mHKA += abs(mHKA_GT-mHKA)
-
-            angles_total.append([LDFA, MPTA, mHKA, LDFA_GT, MPTA_GT, mHKA_GT])
-            if epoch % 5 ==0 and idx == 13:
+            angles = torch.cat([calculate_angles(args, predicted), calculate_angles(args, annotated)], dim=-1)
+
+            highest_probability_pixels[cases] = predicted.cpu().numpy()
+            rmse_total[cases] = rmse.cpu().numpy()
+            rmse_landmarks[:, cases] = rmse_landmark.cpu().numpy().T
+            angles_total[cases] = angles.cpu().numpy()
+
+            if epoch % 5 ==0 and cases.start <= 13 < cases.stop:
+                i = 13 - cases.start
                 angle_overlaid_image_w_label = angle_visualization(
-                    args, args.wandb_name, data_path, idx, epoch, index_list, label_list, 0, angles_total[idx], "without label", 'val'
+                    args, args.wandb_name, [data_path[i]], 13, epoch, highest_probability_pixels[13], None, 0, angles_total[13], "without label", 'val'
                 )
                 angle_overlaid_image_wo_label = angle_visualization(
-                    args, args.wandb_name, data_path, idx, epoch, index_list, label_list, 0, angles_total[idx], "with label", 'val'
+                    args, args.wandb_name, [data_path[i]], 13, epoch, highest_probability_pixels[13], None, 0, angles_total[13], "with label", 'val'
                 )
 
             ## make predictions to be 0. or 1.
@@ -152,12 +286,19 @@ def validate_function(loader, model, args, epoch, device):
             # compare whole picture
             # num_correct += (preds == label).sum()
             # num_pixels += torch.numel(preds)
-            dice_score += (2 * (preds * label).sum()) / ((preds + label).sum() + 1e-8)
+            dice_score += ((2 * (preds * label).sum(dim=(1, 2, 3))) / ((preds + label).sum(dim=(1, 2, 3)) + 1e-8)).sum()
+            start = cases.stop
+
+    angle_diff = np.abs(angles_total[:, :3] - angles_total[:, 3:])
+    total_diff_LDFA, total_diff_MPTA, total_diff_mHKA = angle_diff.sum(axis=0)
+    highest_probability_mse_total = rmse_total.sum()
+    highest_probability_pixels_list = highest_probability_pixels
+    mse_list = rmse_landmarks.tolist()
 
     label_accuracy, label_accuracy2 = 0, 0
     whole_image_accuracy = 0
     # whole_image_accuracy = num_correct/num_pixels*100
-    dice = dice_score/len(loader)
+    dice = dice_score/num_cases
 
     # if epoch % 10 == 0 or epoch % args.dilation_epoch == (args.dilation_epoch-1):
         # label_accuracy = (num_labels_correct/(num_labels+(1e-8))) * 100        ## from GT, how many of them were predicted
@@ -169,8 +310,8 @@ def validate_function(loader, model, args, epoch, device):
         
     # print(f"Got {num_correct}/{num_pixels} with acc {whole_image_accuracy:.2f}")
     print(f"Dice score: {dice}")
-    print(f"Pixel to Pixel Distance: {highest_probability_mse_total/len(loader)}")
-    print(f"Angular Difference: {[total_diff_LDFA/len(loader), total_diff_MPTA/len(loader), total_diff_mHKA/len(loader)]}")
+    print(f"Pixel to Pixel Distance: {highest_probability_mse_total/num_cases}")
+    print(f"Angular Difference: {[total_diff_LDFA/num_cases, total_diff_MPTA/num_cases, total_diff_mHKA/num_cases]}")
     model.train()
 
     evaluation_list = [label_accuracy, label_accuracy2, whole_image_accuracy, predict_as_label, dice]
@@ -178,6 +319,23 @@ def validate_function(loader, model, args, epoch, device):
     return model, evaluation_list, highest_probability_pixels_list, highest_probability_mse_total, mse_list, label_list_total, angle_list, angle_overlaid_image_w_label
 
 
+def save_metrics(args, epoch, highest_probability_mse_total, mse_list, angle_list, num_cases):
+    """
+    validation metrics of the best checkpoint, read by cross_validation.py to aggregate the folds
+    """
+    metrics = {
+        'epoch':          epoch,
+        'num_cases':      num_cases,
+        'rmse':           float(highest_probability_mse_total/num_cases),
+        'rmse_landmarks': [float(np.mean(mse)) for mse in mse_list],
+        'LDFA':           float(angle_list[0]/num_cases),
+        'MPTA':           float(angle_list[1]/num_cases),
+        'mHKA':           float(angle_list[2]/num_cases),
+    }
+    with open(f'./plot_results/{args.wandb_name}/results/metrics.json', 'w') as f:
+        json.dump(metrics, f, indent=4)
+
+
 def train(
         args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle,
         optimizer, train_loader, val_loader
@@ -185,21 +343,24 @@ def train(
     count, pth_save_point = 0, 0
     best_loss, best_angle_mean, best_rmse_mean = np.inf, 89.99, np.inf
     create_directories(args, folder='./plot_results')
+    batch_augmentation = BatchAugmentation(args) if args.augmentation and args.gpu_augmentation else None
+    spatial_mean = SpatialMean_CHAN()
+    ## loss scaling is only needed for float16, bfloat16 on cpu has the float32 range
+    scaler = torch.cuda.amp.GradScaler(enabled=args.amp and DEVICE == 'cuda')
+    erosion_schedule = train_loader.dataset.erosion_schedule
     
     for epoch in range(args.epochs):
         print(f"\nRunning Epoch # {epoch}")
 
+        ## the loaders read the radius from the schedule, so progressive erosion does not rebuild them
+        dilate = erosion_schedule.set_epoch(epoch)
         if epoch % args.dilation_epoch == 0:
             if args.progressive_erosion:
-                train_loader, val_loader, _ = load_data(args)
-                if epoch != 0:
-                    args.dilate = args.dilate - args.dilation_decrease
-                if args.dilate < 1:
-                    args.dilate = 0
+                print(f"Current dilation is {dilate}")
 
             if args.progressive_weight:
                 image_size = args.image_resize * args.image_resize
-                num_of_dil_pixels = calculate_number_of_dilated_pixel(args.dilate)
+                num_of_dil_pixels = calculate_number_of_dilated_pixel(dilate)
                 w0 = (image_size * 100)/(image_size - num_of_dil_pixels)
                 w1 = (image_size * 100)/(num_of_dil_pixels)
                 weight = w1/w0
@@ -207,7 +368,7 @@ def train(
                 loss_fn_pixel = nn.BCEWithLogitsLoss(pos_weight=torch.tensor([weight], device=DEVICE))
 
         loss, loss_pixel, loss_geometry, loss_angle = train_function(
-            args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, optimizer, train_loader
+            args, DEVICE, model, loss_fn_pixel, loss_fn_geometry, loss_fn_angle, optimizer, train_loader, spatial_mean, scaler, batch_augmentation
         )
         model, evaluation_list, highest_probability_pixels_list, highest_probability_mse_total, mse_list, label_list_total, angle_list, angle_overlaid_image = validate_function(
             val_loader, model, args, epoch, device=DEVICE
@@ -216,6 +377,7 @@ def train(
         checkpoint = {
             "state_dict": model.state_dict(),
             "optimizer":  optimizer.state_dict(),
+            "scaler":     scaler.state_dict(),
         }
 
         print("Current loss ", loss)
@@ -232,17 +394,18 @@ def train(
         #     torch.save(checkpoint, f"./results/UNet_Epoch_{epoch}.pth")
         # pth_save_point += 1
 
-        if sum(angle_list)/(len(val_loader)*3) < best_angle_mean:
-            best_angle_mean = sum(angle_list)/(len(val_loader)*3)
+        if sum(angle_list)/(len(val_loader.dataset)*3) < best_angle_mean:
+            best_angle_mean = sum(angle_list)/(len(val_loader.dataset)*3)
             torch.save(checkpoint, f'./plot_results/{args.wandb_name}/results/{args.wandb_name}_best.pth')
+            save_metrics(args, epoch, highest_probability_mse_total, mse_list, angle_list, len(val_loader.dataset))
         if epoch == args.epochs - 1:
             torch.save(checkpoint, f'./plot_results/{args.wandb_name}/results/{args.wandb_name}.pth')
             box_plot(args, mse_list)
             if args.no_image_save:
                 save_predictions_as_images(args, val_loader, model, epoch, highest_probability_pixels_list, label_list_total, device=DEVICE)
 
-        if highest_probability_mse_total/len(val_loader) < best_rmse_mean:
-            best_rmse_mean = highest_probability_mse_total/len(val_loader)
+        if highest_probability_mse_total/len(val_loader.dataset) < best_rmse_mean:
+            best_rmse_mean = highest_probability_mse_total/len(val_loader.dataset)
 
         print(f'pixel loss: {loss_pixel}, geometry loss: {loss_geometry}, angle loss: {loss_angle}')
         print(f'best average rmse diff: {best_rmse_mean}, best average angle diff: {best_angle_mean}')
@@ -252,14 +415,14 @@ def train(
                 log_results(
                     args, loss, loss_pixel, loss_geometry, loss_angle, 
                     evaluation_list, angle_list, best_angle_mean, 
-                    highest_probability_mse_total, mse_list, best_rmse_mean, len(val_loader),
+                    highest_probability_mse_total, mse_list, best_rmse_mean, len(val_loader.dataset),
                     wandb.Image(angle_overlaid_image),
                 )
             else:               
                 log_results_no_label(
                     args, loss, loss_pixel, loss_geometry, loss_angle, 
                     evaluation_list, angle_list, best_angle_mean, 
-                    highest_probability_mse_total, mse_list, best_rmse_mean, len(val_loader),
+                    highest_probability_mse_total, mse_list, best_rmse_mean, len(val_loader.dataset),
                 )
 
         if args.patience and count == args.patience_threshold:
@@ -7,12 +7,13 @@ Reference:
 """
 
 import os
-import math
 import torch
 import numpy as np
 
 from sklearn.metrics import mean_squared_error as mse
 
+from geometry import get_schema, alignment_angles, tensor_alignment_angles
+
 
 def compare_labels(preds, label, num_labels, num_labels_correct, predict_as_label, prediction_correct):
     for i in range(len(preds[0][0])):
@@ -44,14 +45,102 @@ def calculate_mse_predicted_to_annotation(args, highest_probability_pixels, labe
 
 
 def extract_highest_probability_pixel(args, prediction_tensor): 
-    index_list = []
-    for i in range(args.output_channel):
-        index = (prediction_tensor[0][i] == torch.max(prediction_tensor[0][i])).nonzero()
-        if len(index) > 1:
-            index = torch.Tensor([[sum(index)[0]/len(index), sum(index)[1]/len(index)]])
-        index_list.append(index.detach().cpu().numpy())
+    """
+    per channel (y, x) of the maximum of the first case, kept for the old call sites
+    """
+    coordinates = decode_landmarks(prediction_tensor[:1])[0].detach().cpu().numpy()
+    return [coordinates[i:i+1] for i in range(args.output_channel)]
+
+
+def argmax_landmarks(predictions):
+    """
+    (y, x) of the maximum of every channel, ties averaged
+    """
+    _, _, height, width = predictions.shape
+    is_max = predictions == predictions.amax(dim=(-2, -1), keepdim=True)
+    ## integer row/column hit counts keep the tie average exact
+    rows, cols = is_max.sum(dim=-1), is_max.sum(dim=-2)
+    count = rows.sum(dim=-1)
+    y = (rows * torch.arange(height, device=predictions.device)).sum(dim=-1) / count
+    x = (cols * torch.arange(width, device=predictions.device)).sum(dim=-1) / count
+    return torch.stack([y, x], dim=-1)
+
+
+def soft_argmax_landmarks(predictions, beta=1.0):
+    """
+    expected (y, x) under a softmax of beta * predictions over every channel
+    """
+    _, _, height, width = predictions.shape
+    probability = torch.softmax(beta * predictions.float().flatten(2), dim=-1).unflatten(2, (height, width))
+    y = (probability.sum(dim=-1) * torch.arange(height, device=predictions.device)).sum(dim=-1)
+    x = (probability.sum(dim=-2) * torch.arange(width, device=predictions.device)).sum(dim=-1)
+    return torch.stack([y, x], dim=-1)
+
+
+def refine_subpixel(predictions, coordinates):
+    """
+    moves every coordinate to the vertex of the parabola through the pixel it falls on and its
+    two neighbours along each axis, pixels on the border are left as they are
+    """
+    _, _, height, width = predictions.shape
+    predictions = predictions.float()
+    pixel = coordinates.round().long()
+    y, x = pixel[..., 0].clamp(1, height - 2), pixel[..., 1].clamp(1, width - 2)
+
+    def value(dy, dx):
+        index = ((y + dy) * width + (x + dx)).unsqueeze(-1)
+        return predictions.flatten(2).gather(-1, index).squeeze(-1)
+
+    center = value(0, 0)
+    offsets = []
+    for previous, following, border in (
+        (value(-1, 0), value(1, 0), (pixel[..., 0] < 1) | (pixel[..., 0] > height - 2)),
+        (value(0, -1), value(0, 1), (pixel[..., 1] < 1) | (pixel[..., 1] > width - 2)),
+    ):
+        curvature = previous - 2 * center + following
+        offset = 0.5 * (previous - following) / curvature.masked_fill(curvature == 0, 1)
+        ## only a peak (negative curvature) is refined, and never past half a pixel
+        offsets.append(offset.masked_fill((curvature >= 0) | border, 0).clamp(-0.5, 0.5))
+    return pixel.to(coordinates.dtype) + torch.stack(offsets, dim=-1)
+
+
+def decode_landmarks(predictions, decoder='argmax', subpixel=False, beta=1.0):
+    """
+    batched landmark decoding, B x C x H x W logits -> B x C x 2 (y, x) float coordinates computed on
+    the device of predictions, with the argmax (ties averaged) or the soft-argmax of every channel,
+    optionally refined to sub-pixel precision. the input has to be logits, the soft-argmax of
+    probabilities is close to uniform
+    """
+    if decoder == 'soft_argmax': coordinates = soft_argmax_landmarks(predictions, beta)
+    else:                        coordinates = argmax_landmarks(predictions)
+    if subpixel:
+        coordinates = refine_subpixel(predictions, coordinates)
+    return coordinates
+
+
+def stack_label_list(args, label_list):
+    """
+    collated label_list (2*C tensors of shape B) -> B x C x 2 (y, x) tensor
+    """
+    return torch.stack(list(label_list), dim=-1).reshape(-1, args.output_channel, 2)
+
+
+def calculate_landmark_rmse(predicted, label):
+    """
+    batched calculate_mse_predicted_to_annotation, B x C x 2 predicted and label coordinates ->
+    B rmse over all coordinates of a case, B x C rmse of every landmark
+    """
+    squared_error = (predicted.double() - label.double()) ** 2
+    return squared_error.mean(dim=(-2, -1)).sqrt(), squared_error.mean(dim=-1).sqrt()
+
 
-    return index_list
+def get_autocast(args, device):
+    """
+    autocast of --amp, float16 on cuda and bfloat16 on cpu, a no-op without --amp
+    """
+    device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device_type, dtype=dtype, enabled=args.amp)
 
 
 def create_directories(args, folder='./plot_results'):
@@ -91,130 +180,20 @@ def calculate_number_of_dilated_pixel(k):
     return sum
 
 
-def innerProduct(v1, v2):
-    EPSILON = 1e-8
-
-    # θ = inner_product(x, y) / (L2(x) * L2(y))
-    inner_product = np.dot(v1, v2)
-    v1_L2_norm = np.linalg.norm(v1)
-    v2_L2_norm = np.linalg.norm(v2)
-    theta = inner_product / (v1_L2_norm * v2_L2_norm) 
-    if theta < -1:
-        theta = -1 + EPSILON
-    if theta > 1:
-        theta = 1 - EPSILON
-
-    # radian value
-    x = math.acos(theta)
-
-    # pi value
-    return math.degrees(x)
-    
-
-def lateral_distal_femoral_angle(medial_femur, upper_implant_left, upper_implant_center):
-    """
-    calculate angles between
-    Medial Femur - Upper Implant Center / Upper Implant Center - Upper Implant Left
-    """
-    vector1 = [
-        medial_femur[0]-upper_implant_center[0],
-        medial_femur[1]-upper_implant_center[1]
-    ]
-    vector2 = [
-        upper_implant_left[0]-upper_implant_center[0],
-        upper_implant_left[1]-upper_implant_center[1]
-    ]
-    
-    if vector1 == [0,0]:
-        vector1 = [0.1, 0.1]
-    if vector2 == [0,0]:
-        vector2 = [0.1, 0.1]
-
-    return innerProduct(vector1, vector2)
-
-
-def medial_proximal_tibial_angle(lower_implant_left, lower_implant_center, medial_tibia):
+def calculate_angle(args, coordinates, method):
     """
-    calculate angles between
-    Lower Implant Left - Lower Implant Center / Lower Implant Center - Medial Tibia
+    LDFA, MPTA and 180 - mHKA of one case, from the per channel list of extract_highest_probability_pixel ("preds")
+    or from the collated label_list of the loader ("label", first case of the batch)
     """
-    vector1 = [
-        lower_implant_left[0]-lower_implant_center[0],
-        lower_implant_left[1]-lower_implant_center[1]
-    ]
-    vector2 = [
-        medial_tibia[0]-lower_implant_center[0],
-        medial_tibia[1]-lower_implant_center[1]
-    ]
+    if method == "preds": coordinates = np.array(coordinates, dtype=np.float64).reshape(1, -1, 2)
+    else:                 coordinates = np.array([coordinate.numpy()[0] for coordinate in coordinates], dtype=np.float64).reshape(1, -1, 2)
 
-    if vector1 == [0,0]:
-        vector1 = [0.1, 0.1]
-    if vector2 == [0,0]:
-        vector2 = [0.1, 0.1]
-    
-    return innerProduct(vector1, vector2)
+    LDFA, MPTA, mHKA = alignment_angles(coordinates, get_schema(args.output_channel))[0]
+    return LDFA, MPTA, mHKA
 
 
-def mechanical_hip_knee_ankle_angle(medial_femur, upper_implant_center, medial_tibia):
+def calculate_angles(args, coordinates):
     """
-    calculate angles between
-    Medial Femur - Upper Implant Center / Upper Implant Center - Medial Tibia
-    """
-    vector1 = [
-        medial_femur[0]-upper_implant_center[0],
-        medial_femur[1]-upper_implant_center[1]
-    ]
-    vector2 = [
-        medial_tibia[0]-upper_implant_center[0],
-        medial_tibia[1]-upper_implant_center[1]
-    ]
-    
-    if vector1 == [0,0]:
-        vector1 = [0.1, 0.1]
-    if vector2 == [0,0]:
-        vector2 = [0.1, 0.1]
-    
-    return innerProduct(vector1, vector2)
-
-
-def calculate_angle(args, coordinates, method):
+    batched calculate_angle, B x C x 2 (y, x) coordinates -> B x 3 LDFA, MPTA, mHKA
     """
-    calculate angles between
-    Lower Implant Left - Lower Implant Center / Lower Implant Center - Medial Tibia
-    """
-    if method == "preds":
-        if args.output_channel == 6:
-            medial_femur         = [coordinates[0][0][0],coordinates[0][0][1]]
-            upper_implant_left   = [coordinates[1][0][0],coordinates[1][0][1]]
-            upper_implant_center = [coordinates[2][0][0],coordinates[2][0][1]]
-            lower_implant_left   = [coordinates[3][0][0],coordinates[3][0][1]]
-            lower_implant_center = [coordinates[4][0][0],coordinates[4][0][1]]
-            medial_tibia         = [coordinates[5][0][0],coordinates[5][0][1]]
-        else: 
-            medial_femur         = [coordinates[0][0][0],coordinates[0][0][1]]
-            upper_implant_left   = [coordinates[1][0][0],coordinates[1][0][1]]
-            upper_implant_center = [coordinates[3][0][0],coordinates[3][0][1]]
-            lower_implant_left   = [coordinates[4][0][0],coordinates[4][0][1]]
-            lower_implant_center = [coordinates[6][0][0],coordinates[6][0][1]]
-            medial_tibia         = [coordinates[7][0][0],coordinates[7][0][1]]
-    elif method == "label":
-        if args.output_channel == 6:
-            medial_femur         = [coordinates[0].numpy()[0], coordinates[1].numpy()[0]]
-            upper_implant_left   = [coordinates[2].numpy()[0], coordinates[3].numpy()[0]]
-            upper_implant_center = [coordinates[4].numpy()[0], coordinates[5].numpy()[0]]
-            lower_implant_left   = [coordinates[6].numpy()[0], coordinates[7].numpy()[0]]
-            lower_implant_center = [coordinates[8].numpy()[0], coordinates[9].numpy()[0]]
-            medial_tibia         = [coordinates[10].numpy()[0], coordinates[11].numpy()[0]]
-        else: 
-            medial_femur         = [coordinates[0].numpy()[0], coordinates[1].numpy()[0]]
-            upper_implant_left   = [coordinates[2].numpy()[0], coordinates[3].numpy()[0]]
-            upper_implant_center = [coordinates[6].numpy()[0], coordinates[7].numpy()[0]]
-            lower_implant_left   = [coordinates[8].numpy()[0], coordinates[9].numpy()[0]]
-            lower_implant_center = [coordinates[12].numpy()[0], coordinates[13].numpy()[0]]
-            medial_tibia         = [coordinates[14].numpy()[0], coordinates[15].numpy()[0]]
-
-    # print(medial_femur, upper_implant_left, upper_implant_center,lower_implant_left, lower_implant_center, medial_tibia)
-    LDFA = lateral_distal_femoral_angle(medial_femur, upper_implant_left, upper_implant_center)
-    MPTA = medial_proximal_tibial_angle(lower_implant_left, lower_implant_center, medial_tibia)
-    mHKA = mechanical_hip_knee_ankle_angle(medial_femur, upper_implant_center, medial_tibia)
-    return LDFA, MPTA, 180-mHKA
\ No newline at end of file
+    return tensor_alignment_angles(coordinates.double(), get_schema(args.output_channel))
\ No newline at end of file
@@ -51,6 +51,9 @@ import seaborn as sns
 from tqdm import tqdm
 from PIL import Image, ImageDraw, ImageFont
 
+from dataset import to_target_masks
+from utility import get_autocast
+
 
 def save_label_image(args, label_tensor, data_path, label_list, epoch):
     original = Image.open(f'{args.padded_image}/{data_path}').resize((args.image_resize,args.image_resize)).convert("RGB")
@@ -62,7 +65,7 @@ def save_label_image(args, label_tensor, data_path, label_list, epoch):
         pixel_overlaid_image = Image.fromarray(cv2.circle(np.array(original), (x,y), 15, (0, 0, 255),-1))
         pixel_overlaid_image.save(f'./plot_results/{args.wandb_name}/annotation/pixel_label{i}.png')
 
-        background = label_tensor[0][i].unsqueeze(0)
+        background = label_tensor[0][i].float().unsqueeze(0)
         background = TF.to_pil_image(torch.cat((background, background, background), dim=0))
         overlaid_image = Image.blend(original, background , 0.3)
         overlaid_image.save(f'./plot_results/{args.wandb_name}/annotation/epoch{epoch}_overlaid{i}.png')
@@ -76,13 +79,13 @@ def save_heatmap(preds, preds_binary, args, epoch):
 
 
 def prediction_plot(args, idx, highest_probability_pixels_list, i, original):
-    x, y = int(highest_probability_pixels_list[idx][i][0][1]), int(highest_probability_pixels_list[idx][i][0][0])
+    x, y = int(highest_probability_pixels_list[idx][i][1]), int(highest_probability_pixels_list[idx][i][0])
     pixel_overlaid_image = Image.fromarray(cv2.circle(np.array(original), (x,y), 15, (255, 0, 0),-1))
     pixel_overlaid_image.save(f'./plot_results/{args.wandb_name}/overlaid/label{i}/val{idx}_pixel_overlaid.png')
 
 
 def ground_truth_prediction_plot(args, idx, original, epoch, highest_probability_pixels_list, label_list, i):
-    x, y = int(highest_probability_pixels_list[idx][i][0][1]), int(highest_probability_pixels_list[idx][i][0][0])
+    x, y = int(highest_probability_pixels_list[idx][i][1]), int(highest_probability_pixels_list[idx][i][0])
     pixel_overlaid_image = Image.fromarray(cv2.circle(np.array(original), (x,y), 15, (255, 0, 0),-1))
 
     x, y = int(label_list[2*i+1]), int(label_list[2*i])
@@ -105,7 +108,7 @@ def save_overlaid_image(args, idx, predicted_label, data_path, highest_probabili
         # overlaid_image.save(f'./plot_results/{args.wandb_name}/label{i}/epoch_{epoch}_overlaid.png')
         if idx == 13: 
             # ground_truth_prediction_plot(args, idx, original, epoch, highest_probability_pixels_list, label_list, i)
-            x, y = int(highest_probability_pixels_list[idx][i][0][1]), int(highest_probability_pixels_list[idx][i][0][0])
+            x, y = int(highest_probability_pixels_list[idx][i][1]), int(highest_probability_pixels_list[idx][i][0])
             pixel_overlaid_image = Image.fromarray(cv2.circle(np.array(pixel_overlaid_image), (x,y), 10, (255, 0, 0),-1))
             
             # print(count)
@@ -128,22 +131,27 @@ def save_overlaid_image(args, idx, predicted_label, data_path, highest_probabili
 def save_predictions_as_images(args, loader, model, epoch, highest_probability_pixels_list, label_list_total, device="cuda"):
     model.eval()
 
-    for idx, (image, label, data_path, label_list) in enumerate(tqdm(loader)):
+    start = 0
+    for image, label, data_path, label_list in tqdm(loader):
         image = image.to(device=device)
-        label = label.to(device=device)
-        data_path = data_path[0]
+        label = to_target_masks(label, args, device, loader.dataset.dilate)
 
         with torch.no_grad():
-            if args.pretrained: preds = model(image)
-            else:               preds = torch.sigmoid(model(image))
+            with get_autocast(args, device):
+                preds = model(image)
+            preds = torch.sigmoid(preds.float())
             preds_binary = (preds > args.threshold).float()
 
-        if epoch % 5 == 0:
-            save_overlaid_image(args, idx, preds_binary, data_path, highest_probability_pixels_list, label_list, epoch)
-        ## TODO: record heatmaps even if the loss hasn't decreased
-        # if epoch % args.dilation_epoch == (args.dilation_epoch-1) and idx == 0: 
-        if epoch % 50 == 0 and idx == 13:
-            save_label_image(args, label, data_path, label_list, epoch)
+        for i in range(len(image)):
+            idx = start + i
+            case_label_list = [coordinate[i] for coordinate in label_list]
+            if epoch % 5 == 0:
+                save_overlaid_image(args, idx, preds_binary[i:i+1], data_path[i], highest_probability_pixels_list, case_label_list, epoch)
+            ## TODO: record heatmaps even if the loss hasn't decreased
+            # if epoch % args.dilation_epoch == (args.dilation_epoch-1) and idx == 0: 
+            if epoch % 50 == 0 and idx == 13:
+                save_label_image(args, label[i:i+1], data_path[i], case_label_list, epoch)
+        start += len(image)
         # if args.pixel_loss and (epoch % 10 == 0 or epoch % args.dilation_epoch == (args.dilation_epoch-1)):
         #     if args.dilation_epoch >= 10:
         #         save_overlaid_image(args, idx, preds_binary, data_path, highest_probability_pixels_list, label_list, epoch)
@@ -207,8 +215,8 @@ def angle_visualization(
     font = ImageFont.truetype("plot_data/font/Gidole-Regular.ttf", size=font_size)
 
     for i in range(args.output_channel):
-        # x, y = int(highest_probability_pixels_list[idx][i][0][1]), int(highest_probability_pixels_list[idx][i][0][0])
-        x, y = int(highest_probability_pixels_list[i][0][1]), int(highest_probability_pixels_list[i][0][0])
+        # x, y = int(highest_probability_pixels_list[idx][i][1]), int(highest_probability_pixels_list[idx][i][0])
+        x, y = int(highest_probability_pixels_list[i][1]), int(highest_probability_pixels_list[i][0])
         pixels.append([x,y])
        
         if count <= 2: angle_overlaid_image = Image.fromarray(cv2.circle(np.array(angle_overlaid_image), (x,y), circle_size, red,-1))